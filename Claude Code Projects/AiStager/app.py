@@ -1,22 +1,40 @@
 import os
 import time
-import requests
 import base64
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, Response, request, jsonify, render_template_string
 from flask_cors import CORS
 from dotenv import load_dotenv
-import json
 from datetime import datetime
 import uuid
+import atexit
 import hashlib
-import io
+import hmac
+import math
+import tempfile
 import cloudinary
-import cloudinary.uploader
+from fingerprint import FINGERPRINT_COLUMNS, FingerprintIndex
+from image_store import EXTENSIONS, create_image_store, send_image
+from imaging import ImageError, fingerprint_image
+from notify import Notifier
+from job_store import JobDatabase
+from polling import BackoffPoller, PollTimeout
+from reimagine import ReimagineClient, ReimagineError, ReimagineUnavailable
+from hosting import CloudinaryProvider, HostingRacer, ImgBBProvider, LocalProvider
+from ratelimit import AdmissionControl, RateLimited
+from media import MediaMirror
+from result_cache import ResultCache
+from tracing import Metrics
+from reconcile import RECONCILE_AFTER, RECONCILE_GIVE_UP, Reconciler, next_check_at
+from webhooks import WebhookDeduper, WebhookQueue, is_final, log_event, merge_results, webhook_result
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 load_dotenv('.env.local')  # Explicitly load .env.local
 
 app = Flask(__name__)
 CORS(app)
+# Render terminates requests at a proxy; trust its X-Forwarded-For so
+# rate limits key on the real client address
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('PROXY_HOPS', 1)))
 
 # Get API key from environment
 REIMAGINEHOME_API_KEY = os.getenv('REIMAGINEHOME_API_KEY')
@@ -39,10 +57,92 @@ if CLOUDINARY_CLOUD_NAME and CLOUDINARY_API_KEY and CLOUDINARY_API_SECRET:
 else:
     CLOUDINARY_CONFIGURED = False
 
-# Store staging results in memory
-STAGING_JOBS = {}
-COMPLETED_STAGINGS = {}
-TEMP_IMAGES = {}  # Store images temporarily
+# Staging jobs and results live in SQLite so they survive restarts and are
+# shared by every gunicorn worker. Jobs are not cached in-process: a later
+# callback handled by another worker may still add outputs to a completed one
+JOB_DB = JobDatabase(os.getenv('JOB_DB_PATH', os.path.join(tempfile.gettempdir(), 'aistager', 'stagings.db')))
+STAGING_JOBS = JOB_DB.table(
+    'staging_jobs',
+    indexed=('reimagine_job_id', 'status', 'created_at', 'completed_at', 'next_check_at')
+)
+# The recent-stagings feed reads this newest-first through the completed_at
+# index; only the newest RECENT_STAGINGS_KEEP rows are retained
+COMPLETED_STAGINGS = JOB_DB.table(
+    'completed_stagings',
+    indexed=('completed_at', 'space_type', 'design_theme'),
+    cache_if=bool
+)
+RECENT_STAGINGS_KEEP = int(os.getenv('RECENT_STAGINGS_KEEP', 1000))
+RECENT_STAGINGS_MAX_PAGE = 50
+TEMP_IMAGES = create_image_store()  # Locally served images, size-bounded with expiry
+# Staged outputs are mirrored locally with thumbnail and web renditions
+MEDIA = MediaMirror(
+    create_image_store('MEDIA_STORE', max_mb=1024, ttl=30 * 24 * 3600, directory_name='aistager-media'),
+    JOB_DB.table('media', cache_if=bool)
+)
+
+# Pooled ReimagineHome client with per-endpoint circuit breakers
+REIMAGINE = ReimagineClient(REIMAGINEHOME_API_KEY)
+
+# Mask status polling; the first check adapts to observed mask latency
+MASK_POLLER = BackoffPoller(
+    initial_delay=float(os.getenv('MASK_POLL_INITIAL_DELAY', 0.5)),
+    max_delay=float(os.getenv('MASK_POLL_MAX_DELAY', 8)),
+    deadline=float(os.getenv('MASK_POLL_DEADLINE', 40))
+)
+
+# Remote hosts are raced; the local /temp-image route is the fallback
+HOSTING = HostingRacer(
+    providers=(
+        ([ImgBBProvider(IMGBB_API_KEY)] if IMGBB_API_KEY else [])
+        + ([CloudinaryProvider()] if CLOUDINARY_CONFIGURED else [])
+    ),
+    fallback=LocalProvider(TEMP_IMAGES, EXTENSIONS)
+)
+
+# Each photo is hosted once: later uploads of it, exact or re-encoded, map
+# to the first copy and reuse its URL while that is still served
+HOSTED_IMAGES = JOB_DB.table('hosted_images')
+FINGERPRINTS = FingerprintIndex(
+    JOB_DB.table('fingerprints', indexed=FINGERPRINT_COLUMNS),
+    exists=lambda image_id: hosted_url(image_id) is not None
+)
+
+# Per-stage latency histograms and counters for /metrics, summed across workers
+METRICS = Metrics(store=JOB_DB.table('metrics', indexed=('updated_at',)))
+
+# Per-client rate limits and a cap on concurrent stagings (each holds a
+# request thread for up to a minute). The limits, the clients' buckets and
+# the in-flight count are kept in the job database, so they hold across all
+# workers and /api/admin/limits changes reach each one.
+ADMISSION = AdmissionControl(
+    defaults={
+        'rate_per_minute': float(os.getenv('STAGE_RATE_PER_MINUTE', 10)),
+        'burst': float(os.getenv('STAGE_BURST', 5)),
+        'max_active': int(os.getenv('STAGE_MAX_ACTIVE', 8)),
+        'max_waiting': int(os.getenv('STAGE_MAX_WAITING', 16)),
+        'wait_timeout': float(os.getenv('STAGE_WAIT_TIMEOUT', 20))
+    },
+    store=JOB_DB.table('settings'),
+    buckets=JOB_DB.table('rate_buckets', indexed=('updated_at',)),
+    slots=JOB_DB.table('admission')
+)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Callers sending one of these as X-API-Key get their own rate-limit bucket;
+# any other header is ignored and the caller is limited by address
+STAGE_API_KEYS = [key.strip() for key in os.getenv('STAGE_API_KEYS', '').split(',') if key.strip()]
+
+# Wakes /api/check-job long-polls when a webhook completes their job. At
+# most half of a worker's threads may be held by long-polls, so webhooks and
+# stagings always get a thread.
+NOTIFIER = Notifier(max_waiters=int(os.getenv('MAX_WAITERS', int(os.getenv('GUNICORN_THREADS', 32)) // 2)))
+MAX_LONG_POLL = 30.0
+
+# Webhooks are acknowledged right away and processed in the background
+WEBHOOKS = WebhookQueue(maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+atexit.register(WEBHOOKS.drain)
+# Repeated deliveries of the same callback are dropped before queueing
+WEBHOOK_DEDUPE = WebhookDeduper(JOB_DB.table('webhook_deliveries', indexed=('received_at',)))
 
 print("=== UNIQUE DEPLOYMENT TEST: 12345 ===")
 print(f"ReimagineHome API configured: {'Yes' if REIMAGINEHOME_API_KEY else 'No'}")
@@ -223,55 +323,68 @@ HTML_TEMPLATE = '''
         }
         
         async function pollForResults(jobId) {
-            const maxAttempts = 30; // 60 seconds
-            let attempts = 0;
+            // Long-poll: each request returns as soon as the job completes,
+            // or at once when the server is busy, so polls are spaced
+            const started = Date.now();
+            const maxWait = 5 * 60 * 1000;
             
-            const interval = setInterval(async () => {
-                attempts++;
-                
-                const percent = Math.min(50 + (attempts * 1.5), 95);
-                showProgress(percent, 'Processing... (' + Math.round(attempts * 2) + 's)');
+            while (Date.now() - started < maxWait) {
+                const sent = Date.now();
+                const elapsed = Math.round((Date.now() - started) / 1000);
+                const percent = Math.min(50 + (elapsed * 0.75), 95);
+                showProgress(percent, 'Processing... (' + elapsed + 's)');
                 
                 try {
-                    const response = await fetch(`/api/check-job/${jobId}`);
+                    const response = await fetch(`/api/check-job/${jobId}?wait=10`);
                     const data = await response.json();
                     
                     if (data.completed) {
-                        clearInterval(interval);
                         showProgress(100, 'Complete!');
                         displayResults(data.result);
                         loadRecentStagings();
                         setTimeout(hideProgress, 2000);
-                    } else if (attempts >= maxAttempts) {
-                        clearInterval(interval);
+                        return;
+                    }
+                    if (data.failed) {
                         hideProgress();
                         document.getElementById('status').innerHTML = `
-                            <div class="bg-yellow-50 p-4 rounded">
-                                <p class="text-yellow-800">Processing is taking longer than expected.</p>
-                                <p class="text-sm text-yellow-600 mt-1">Check back in a minute or refresh the page.</p>
+                            <div class="bg-red-50 p-4 rounded">
+                                <p class="text-red-800">${data.error || 'Staging failed. Please try again.'}</p>
                             </div>
                         `;
+                        return;
                     }
                 } catch (error) {
                     console.error('Poll error:', error);
                 }
-            }, 2000);
+                await new Promise(resolve => setTimeout(resolve, Math.max(0, sent + 2000 - Date.now())));
+            }
+            
+            hideProgress();
+            document.getElementById('status').innerHTML = `
+                <div class="bg-yellow-50 p-4 rounded">
+                    <p class="text-yellow-800">Processing is taking longer than expected.</p>
+                    <p class="text-sm text-yellow-600 mt-1">Check back in a minute or refresh the page.</p>
+                </div>
+            `;
         }
         
         function displayResults(result) {
             const results = document.getElementById('results');
             
-            if (result.output_urls && result.output_urls.length > 0) {
+            // Prefer our mirrored renditions; fall back to ReimagineHome's URLs
+            const media = result.media || (result.output_urls || []).map(url => ({ url }));
+            if (media.length > 0) {
                 results.innerHTML = `
                     <div class="bg-green-50 p-4 rounded mb-4">
                         <p class="text-green-800 font-semibold">🎉 Your room has been staged!</p>
                     </div>
                     <div class="grid grid-cols-1 gap-4">
-                        ${result.output_urls.map((url, index) => `
+                        ${media.map(item => `
                             <div class="border rounded overflow-hidden">
-                                <img src="${url}" class="w-full" alt="Staged room">
+                                <img src="${item.web || item.url}" class="w-full" alt="Staged room">
                                 <div class="p-2 bg-gray-50">
-                                    <a href="${url}" target="_blank" class="text-sm text-blue-600 hover:underline">
+                                    <a href="${item.original || item.url}" target="_blank" class="text-sm text-blue-600 hover:underline">
                                         View full size ↗
                                     </a>
                                 </div>
@@ -304,9 +417,9 @@ HTML_TEMPLATE = '''
                             </div>
                             ${staging.output_urls ? `
                                 <div class="grid grid-cols-2 gap-2">
-                                    ${staging.output_urls.map(url => `
-                                        <a href="${url}" target="_blank">
-                                            <img src="${url}" class="w-full h-32 object-cover rounded hover:opacity-80">
+                                    ${(staging.media || staging.output_urls.map(url => ({ url }))).map(item => `
+                                        <a href="${item.original || item.url}" target="_blank">
+                                            <img src="${item.thumb || item.url}" loading="lazy" class="w-full h-32 object-cover rounded hover:opacity-80">
                                         </a>
                                     `).join('')}
                                 </div>
@@ -329,89 +442,181 @@ HTML_TEMPLATE = '''
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+def unavailable_response(retry_after):
+    """503 sent while a ReimagineHome circuit breaker is open"""
+    response = jsonify({
+        'success': False,
+        'error': 'The staging service is temporarily unavailable. Please try again shortly.'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+def client_key():
+    """Rate-limit key: the caller's API key if it is one of STAGE_API_KEYS, else its address"""
+    supplied = request.headers.get('X-API-Key', '').encode()
+    for api_key in STAGE_API_KEYS:
+        if hmac.compare_digest(supplied, api_key.encode()):
+            return 'key:' + hashlib.sha256(supplied).hexdigest()[:16]
+    return request.remote_addr or 'unknown'
+
+def rate_limited_response(error):
+    response = jsonify({'success': False, 'error': str(error)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(error.retry_after) + 1)
+    return response
+
 @app.route('/api/stage', methods=['POST'])
 def stage():
-    """Complete staging endpoint with all fixes"""
+    """Stage an uploaded image.
+    
+    A repeat of an earlier staging returns that job unless force is set;
+    repeats are answered before admission, so they cost no rate-limit
+    tokens or slots. New stagings are admitted under the rate limits.
+    """
     data = request.json
     print(f"\n=== New staging request at {datetime.now().isoformat()} ===")
     
     image_data = data.get('image')
     space_type = data.get('space_type')
     design_theme = data.get('design_theme')
+    force = bool(data.get('force'))
     
     if not image_data or not space_type:
         print("[ERROR] Missing required fields")
         return jsonify({'success': False, 'error': 'Missing required fields'})
     
-    headers = {'api-key': REIMAGINEHOME_API_KEY}
+    # Create a unique job ID for this staging; its spans are logged under it
+    internal_job_id = str(uuid.uuid4())[:12]
     
     try:
-        # Extract base64 data
-        base64_data = image_data.split(',')[1] if ',' in image_data else image_data
-        image_bytes = base64.b64decode(base64_data)
-        
-        # Try to upload to external service first
-        image_url = None
-        
-        # Try ImgBB first (most reliable)
-        if IMGBB_API_KEY:
-            try:
-                print("Uploading to ImgBB...")
-                imgbb_response = requests.post(
-                    'https://api.imgbb.com/1/upload',
-                    data={
-                        'key': IMGBB_API_KEY,
-                        'image': base64_data,  # ImgBB accepts base64 directly
-                        'name': f'room_{int(time.time())}'
-                    },
-                    timeout=30
-                )
-                
-                if imgbb_response.status_code == 200:
-                    imgbb_data = imgbb_response.json()
-                    if imgbb_data.get('success'):
-                        image_url = imgbb_data['data']['url']
-                        print(f"Image uploaded to ImgBB: {image_url}")
-                    else:
-                        print(f"ImgBB error: {imgbb_data}")
-                else:
-                    print(f"ImgBB upload failed with status: {imgbb_response.status_code}")
-            except Exception as e:
-                print(f"ImgBB upload failed: {e}")
-        
-        # Try Cloudinary as backup
-        if not image_url and CLOUDINARY_CONFIGURED:
-            try:
-                print("Trying Cloudinary as backup...")
-                upload_result = cloudinary.uploader.upload(
-                    image_bytes,
-                    public_id=f"room_{int(time.time())}",
-                    folder="aistager",
-                    format="jpg"
-                )
-                image_url = upload_result.get('secure_url')
-                print(f"Image uploaded to Cloudinary: {image_url}")
-            except Exception as e:
-                print(f"Cloudinary upload failed: {e}")
-        
-        # If external upload failed, use local serving
-        if not image_url:
-            # Generate unique ID for image
-            image_id = hashlib.md5(f"{time.time()}{len(image_bytes)}".encode()).hexdigest()[:16]
-            TEMP_IMAGES[image_id] = image_bytes
-            
-            # Create URL - this will be public when deployed on Render
-            base_url = request.url_root.rstrip('/')
-            image_url = f"{base_url}/temp-image/{image_id}.jpg"
-            print(f"Image served locally at: {image_url}")
-        
-        # Create a unique job ID for this staging
-        internal_job_id = str(uuid.uuid4())[:12]
+        with METRICS.span('upload_decode', internal_job_id):
+            # Extract base64 data
+            header, _, base64_data = image_data.rpartition(',')
+            mimetype = header[len('data:'):].split(';')[0] if header.startswith('data:') else 'image/jpeg'
+            if mimetype not in EXTENSIONS:
+                mimetype = 'image/jpeg'
+            image_bytes = base64.b64decode(base64_data)
+            image_id = match_upload(image_bytes)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)})
+    
+    if force:
+        RESULT_CACHE.skipped()
+    else:
+        cached = RESULT_CACHE.get(image_id, space_type, design_theme)
+        if cached:
+            print(f"Reusing staging {cached['job_id']} for image {image_id}")
+            return jsonify(cached)
+    
+    # Fail fast while ReimagineHome is known to be down
+    retry_after = max(REIMAGINE.breakers[name].retry_after() for name in ('create_mask', 'generate_image'))
+    if retry_after:
+        return unavailable_response(retry_after)
+    
+    try:
+        ADMISSION.check_rate(client_key())
+        ADMISSION.acquire()
+    except RateLimited as e:
+        return rate_limited_response(e)
+    
+    try:
+        return stage_image(internal_job_id, image_bytes, mimetype, image_id, space_type, design_theme)
+    finally:
+        ADMISSION.release()
+
+def hosted_url(image_id):
+    """URL an earlier staging hosted this image at, or None if it is gone"""
+    hosted = HOSTED_IMAGES.get(image_id)
+    if hosted is None or (hosted['host'] == 'local' and image_id not in TEMP_IMAGES):
+        return None
+    return hosted['url']
+
+def match_upload(image_bytes):
+    """Image id for an upload: that of an earlier copy of the same photo, else its content hash"""
+    digest = hashlib.md5(image_bytes).hexdigest()
+    image_id = FINGERPRINTS.exact(digest)
+    if image_id:
+        return image_id
+    try:
+        phash, thumb, size = fingerprint_image(image_bytes)
+    except ImageError:
+        # Let ReimagineHome judge formats Pillow cannot read
+        return digest[:16]
+    match = FINGERPRINTS.similar(phash, thumb, size)
+    image_id = match[0] if match else digest[:16]
+    FINGERPRINTS.add(digest, image_id, phash, thumb, size)
+    return image_id
+
+def reuse_staging(entry):
+    """Answer for a repeat of a staging that finished or is still running, else None"""
+    job = STAGING_JOBS.get(entry['job_id'])
+    if job is None or job['status'] == 'failed':
+        return None
+    response = {'success': True, 'job_id': job['job_id'], 'cached': True}
+    if job['status'] == 'completed':
+        output_urls = job.get('output_urls', [])
+        response.update(
+            completed=True,
+            message='Staging already done',
+            result={'output_urls': output_urls, 'media': MEDIA.media_for(output_urls)}
+        )
+    else:
+        response['message'] = 'Staging job submitted successfully!'
+    return response
+
+# Repeats of a staging (same image, space_type and design_theme) reuse its job
+RESULT_CACHE = ResultCache(
+    JOB_DB.table('result_cache', indexed=('cached_at',)),
+    resolve=reuse_staging
+)
+
+def stage_image(internal_job_id, image_bytes, mimetype, image_id, space_type, design_theme):
+    """Host an admitted upload and start its staging with ReimagineHome.
+    
+    A staging that stops short of generate_image is marked failed with the
+    error returned to the caller, so its record is not left processing.
+    """
+    response = start_staging(internal_job_id, image_bytes, mimetype, image_id, space_type, design_theme)
+    error = (response.get_json(silent=True) or {}).get('error')
+    if error:
+        fail_staging(internal_job_id, error)
+    return response
+
+def fail_staging(job_id, error):
+    """Fail a staging that never reached ReimagineHome's generate step"""
+    def fail(job):
+        if not job or job['status'] != 'processing' or job.get('reimagine_job_id'):
+            return job, False
+        job['status'] = 'failed'
+        job['error'] = error
+        return job, True
+    
+    if STAGING_JOBS.transact(job_id, fail):
+        log_event('staging_failed', job_id=job_id, error=error)
+        NOTIFIER.notify(job_id)
+
+def start_staging(internal_job_id, image_bytes, mimetype, image_id, space_type, design_theme):
+    """Host the image, create its masks and start generation; returns the response"""
+    try:
+        image_url = hosted_url(image_id)
+        if image_url:
+            print(f"Reusing hosted image {image_id}: {image_url}")
+        else:
+            # Race the configured hosts; falls back to serving the image locally
+            with METRICS.span('hosting', internal_job_id) as labels:
+                image_url, host = HOSTING.host(image_bytes, mimetype, image_id, request.url_root.rstrip('/'))
+                labels['provider'] = host
+            HOSTED_IMAGES[image_id] = {'url': image_url, 'host': host, 'hosted_at': datetime.now().isoformat()}
+            print(f"Image hosted by {host}: {image_url}")
         
         # Store job info
         STAGING_JOBS[internal_job_id] = {
+            'job_id': internal_job_id,
             'status': 'processing',
             'created_at': datetime.now().isoformat(),
+            'image_id': image_id,
             'space_type': space_type,
             'design_theme': design_theme
         }
@@ -421,86 +626,93 @@ def stage():
         
         # Step 1: Create masks
         print(f"Sending image to ReimagineHome API: {image_url}")
-        mask_response = requests.post(
-            'https://api.reimaginehome.ai/v1/create_mask',
-            headers=headers,
-            json={'image_url': image_url}
-        )
+        try:
+            with METRICS.span('create_mask', internal_job_id):
+                mask_job_id = REIMAGINE.create_mask(image_url)
+        except ReimagineUnavailable as e:
+            return unavailable_response(e.retry_after)
+        except ReimagineError as e:
+            print(f"[ERROR] ReimagineHome API error: {e}")
+            print(f"Full error response: {e.payload}")
+            return jsonify({
+                'success': False,
+                'error': (e.payload or {}).get('error_message', 'Image processing failed')
+            })
         
-        print(f"Mask API response status: {mask_response.status_code}")
-        if mask_response.status_code == 200:
-            mask_job_id = mask_response.json()['data']['job_id']
-            
-            # Step 2: Wait for masks
+        # Step 2: Wait for masks
+        def check_masks():
+            try:
+                with METRICS.span('mask_status', internal_job_id):
+                    status_data = REIMAGINE.get_mask_status(mask_job_id)
+            except ReimagineUnavailable:
+                raise
+            except ReimagineError:
+                return None
+            if status_data.get('job_status') == 'done':
+                return status_data.get('masks') or []
+            return None
+        
+        try:
+            masks, poll_info = MASK_POLLER.poll(check_masks)
+        except PollTimeout as e:
             masks = None
-            for i in range(20):
-                time.sleep(2)
-                status_response = requests.get(
-                    f'https://api.reimaginehome.ai/v1/create_mask/{mask_job_id}',
-                    headers=headers
-                )
-                
-                if status_response.status_code == 200:
-                    status_data = status_response.json()
-                    if status_data.get('data', {}).get('job_status') == 'done':
-                        masks = status_data['data']['masks']
-                        break
-            
-            if masks:
-                # Step 3: Generate staged image
-                furnishing_masks = [m['url'] for m in masks if 'furnishing' in m.get('category', '')]
-                if not furnishing_masks:
-                    masks_sorted = sorted(masks, key=lambda x: x.get('area_percent', 0), reverse=True)
-                    mask_urls = [masks_sorted[0]['url']] if masks_sorted else []
-                else:
-                    mask_urls = furnishing_masks
-                
-                generation_payload = {
-                    'image_url': image_url,
-                    'mask_urls': mask_urls,
-                    'mask_category': 'furnishing',
-                    'space_type': space_type,
-                    'generation_count': 1,
-                    'webhook_url': webhook_url
-                }
-                
-                if design_theme:
-                    generation_payload['design_theme'] = design_theme
-                    
-                gen_response = requests.post(
-                    'https://api.reimaginehome.ai/v1/generate_image',
-                    headers=headers,
-                    json=generation_payload
-                )
-                
-                if gen_response.status_code == 200:
-                    reimagine_job_id = gen_response.json().get('data', {}).get('job_id', 'unknown')
-                    STAGING_JOBS[internal_job_id]['reimagine_job_id'] = reimagine_job_id
-                    
-                    return jsonify({
-                        'success': True,
-                        'job_id': internal_job_id,
-                        'message': 'Staging job submitted successfully!'
-                    })
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Failed to start staging process'
-                    })
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': 'Failed to process room layout'
-                })
+            METRICS.record('mask_wait', e.elapsed, internal_job_id, outcome='timeout')
+        except ReimagineUnavailable as e:
+            # Stop polling instead of waiting out the rest of the budget
+            return unavailable_response(e.retry_after)
+        else:
+            METRICS.record('mask_wait', poll_info['elapsed'], internal_job_id)
+        if not masks:
+            return jsonify({
+                'success': False,
+                'error': 'Failed to process room layout'
+            })
+        
+        # Step 3: Generate staged image
+        furnishing_masks = [m['url'] for m in masks if 'furnishing' in m.get('category', '')]
+        if not furnishing_masks:
+            masks_sorted = sorted(masks, key=lambda x: x.get('area_percent', 0), reverse=True)
+            mask_urls = [masks_sorted[0]['url']] if masks_sorted else []
         else:
-            error_data = mask_response.json()
-            error_msg = error_data.get('error_message', 'Image processing failed')
-            print(f"[ERROR] ReimagineHome API error: {error_msg}")
-            print(f"Full error response: {error_data}")
+            mask_urls = furnishing_masks
+        
+        generation_payload = {
+            'image_url': image_url,
+            'mask_urls': mask_urls,
+            'mask_category': 'furnishing',
+            'space_type': space_type,
+            'generation_count': 1,
+            'webhook_url': webhook_url
+        }
+        
+        if design_theme:
+            generation_payload['design_theme'] = design_theme
+        
+        try:
+            with METRICS.span('generate_image', internal_job_id):
+                reimagine_job_id = REIMAGINE.generate_image(generation_payload) or 'unknown'
+        except ReimagineUnavailable as e:
+            return unavailable_response(e.retry_after)
+        except ReimagineError as e:
+            print(f"[ERROR] generate_image failed: {e}")
             return jsonify({
                 'success': False,
-                'error': error_msg
+                'error': 'Failed to start staging process'
             })
+        
+        job = STAGING_JOBS[internal_job_id]
+        job['reimagine_job_id'] = reimagine_job_id
+        job['submitted_at'] = datetime.now().isoformat()
+        # Checked upstream by the reconciler if no webhook arrives by then
+        job['next_check_at'] = next_check_at()
+        STAGING_JOBS[internal_job_id] = job
+        RESULT_CACHE.put(image_id, space_type, design_theme, job_id=internal_job_id)
+        
+        return jsonify({
+            'success': True,
+            'job_id': internal_job_id,
+            'message': 'Staging job submitted successfully!'
+        })
             
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -508,68 +720,210 @@ def stage():
 
 @app.route('/webhook/reimaginehome/<job_id>', methods=['POST'])
 def webhook_receiver(job_id):
-    """Receive staging results from ReimagineHome"""
-    print(f"\\n🎉 Webhook received for job: {job_id}")
+    """Receive staging results from ReimagineHome.
     
-    try:
-        data = request.json
-        print(f"Webhook data: {json.dumps(data, indent=2)}")
-        
-        # Store the completed staging
-        if job_id in STAGING_JOBS:
-            STAGING_JOBS[job_id]['status'] = 'completed'
-            STAGING_JOBS[job_id]['completed_at'] = datetime.now().isoformat()
-            STAGING_JOBS[job_id]['result'] = data
-            
-            # Extract output URLs
-            output_urls = []
-            if data and 'output_urls' in data:
-                output_urls = data['output_urls']
-            elif data and 'data' in data and 'output_urls' in data['data']:
-                output_urls = data['data']['output_urls']
-            
-            STAGING_JOBS[job_id]['output_urls'] = output_urls
-            
-            # Also store in completed stagings
+    The payload is only validated here; complete_staging() records it on
+    the webhook queue's background thread.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'error': 'Expected a JSON object'}), 400
+    
+    claim = WEBHOOK_DEDUPE.claim(f'job:{job_id}', request.get_data())
+    if claim is None:
+        return jsonify({'status': 'success', 'received': True, 'duplicate': True})
+    if not WEBHOOKS.submit(complete_staging, job_id, data):
+        WEBHOOK_DEDUPE.release(claim)
+        log_event('webhook_rejected', job_id=job_id, reason='queue_full')
+        response = jsonify({'status': 'error', 'error': 'Busy, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    return jsonify({'status': 'success', 'received': True})
+
+def complete_staging(job_id, data, via='webhook'):
+    """Merge a staging's results into its job and wake anyone waiting on it"""
+    update = webhook_result(data)
+    
+    def merge(job):
+        if not job:
+            return None, (None, None, None, False)
+        result, outcome = merge_results(job.get('result'), update)
+        if result is None:
+            return job, (job, None, outcome, False)
+        job['result'] = result
+        job['output_urls'] = result['output_urls']
+        first_final = is_final(result) and not job.get('completed_at')
+        if is_final(result):
+            job['status'] = 'completed'
+            job['completed_at'] = job.get('completed_at') or datetime.now().isoformat()
+            # Also store in completed stagings; a later callback updates the
+            # same row. The tables share this thread's connection, so the row
+            # commits in the same transaction as the job.
+            completed_at = datetime.fromisoformat(job['completed_at'])
             COMPLETED_STAGINGS[job_id] = {
                 'job_id': job_id,
-                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M'),
-                'output_urls': output_urls,
-                'space_type': STAGING_JOBS[job_id].get('space_type'),
-                'design_theme': STAGING_JOBS[job_id].get('design_theme')
+                'timestamp': completed_at.strftime('%Y-%m-%d %H:%M'),
+                'completed_at': completed_at.isoformat(),
+                'output_urls': result['output_urls'],
+                'space_type': job.get('space_type'),
+                'design_theme': job.get('design_theme')
             }
-            
-            print(f"✅ Staging completed! URLs: {output_urls}")
-        
-        return jsonify({'status': 'success', 'received': True})
+        return job, (job, result, outcome, first_final)
+    
+    # One transaction, so a progress callback handled at the same time by
+    # another worker (or the reconciler) cannot overwrite the final result
+    job, result, outcome, first_final = STAGING_JOBS.transact(job_id, merge)
+    if not job:
+        log_event('webhook', job_id=job_id, known=False)
+        return
+    
+    WEBHOOK_DEDUPE.count(outcome)
+    METRICS.inc('events_total', kind=via, outcome=outcome)
+    if result is None:
+        # A repeat, or progress arriving after the final result
+        return
+    if not is_final(result):
+        log_event('webhook', job_id=job_id, known=True, progress=result['job_status'])
+        return
+    
+    if first_final:
+        completed_at = datetime.fromisoformat(job['completed_at'])
+        if job.get('submitted_at'):
+            waited = completed_at - datetime.fromisoformat(job['submitted_at'])
+            METRICS.record('webhook_wait', waited.total_seconds(), job_id, via=via)
+        METRICS.record('total', (completed_at - datetime.fromisoformat(job['created_at'])).total_seconds(), job_id)
+    COMPLETED_STAGINGS.trim('completed_at', RECENT_STAGINGS_KEEP)
+    MEDIA.mirror(result['output_urls'])
+    
+    NOTIFIER.notify(job_id)
+    log_event('webhook', job_id=job_id, known=True, outputs=len(result['output_urls']))
+
+def reconcile_staging(job):
+    """Ask ReimagineHome about a staging whose webhook has not arrived"""
+    job_id = job['job_id']
+    
+    def reschedule(current):
+        # Only the schedule changes, on the stored record: `job` may be stale
+        # by now if the webhook completed the staging meanwhile
+        if not current or current['status'] != 'processing':
+            return current, None
+        checks = current.get('reconcile_checks', 0) + 1
+        current['reconcile_checks'] = checks
+        current['next_check_at'] = next_check_at(min(RECONCILE_AFTER * checks, 600))
+        return current, current
+    
+    # Reschedule first so a failing check cannot keep the job at the front
+    job = STAGING_JOBS.transact(job_id, reschedule)
+    if job is None:
+        return 'settled'
+    
+    try:
+        with METRICS.span('generation_status', job_id):
+            data = REIMAGINE.get_generation_status(job['reimagine_job_id'])
+    except ReimagineUnavailable:
+        raise
+    except ReimagineError as e:
+        log_event('reconcile_error', job_id=job_id, error=str(e))
+        data = None
+    
+    if data and is_final(webhook_result(data)):
+        complete_staging(job_id, data, via='reconcile')
+        return 'completed'
+    
+    age = (datetime.now() - datetime.fromisoformat(job['created_at'])).total_seconds()
+    if age > RECONCILE_GIVE_UP:
+        def time_out(current):
+            if not current or current['status'] != 'processing':
+                return current, False
+            current['status'] = 'failed'
+            current['error'] = 'Staging timed out. Please try again.'
+            return current, True
         
-    except Exception as e:
-        print(f"Webhook error: {str(e)}")
-        return jsonify({'status': 'error', 'error': str(e)}), 500
+        if STAGING_JOBS.transact(job_id, time_out):
+            NOTIFIER.notify(job_id)
+        return 'timed_out'
+    return 'pending'
+
+# Settles stagings whose webhook was lost
+RECONCILER = Reconciler(
+    find_due=lambda now, limit: STAGING_JOBS.due('next_check_at', now, limit, status='processing'),
+    settle=reconcile_staging,
+    leases=JOB_DB.table('sweeps', indexed=('claimed_at',))
+)
+
+@app.before_request
+def start_reconciler():
+    RECONCILER.start()
 
 @app.route('/api/check-job/<job_id>')
 def check_job(job_id):
-    """Check if a staging job is completed"""
-    if job_id in STAGING_JOBS and STAGING_JOBS[job_id]['status'] == 'completed':
-        return jsonify({
-            'completed': True,
-            'result': {
-                'output_urls': STAGING_JOBS[job_id].get('output_urls', [])
-            }
-        })
-    return jsonify({'completed': False})
+    """Check if a staging job is completed.
+    
+    With ?wait=<seconds> this long-polls until the webhook completes the
+    job or the wait runs out.
+    """
+    wait = request.args.get('wait', 0, type=float)
+    if not math.isfinite(wait):
+        # nan passes min() and max() unchanged and would never time out
+        return jsonify({'success': False, 'error': 'wait must be a number of seconds'}), 400
+    wait = min(max(wait, 0), MAX_LONG_POLL)
+    # Past the waiter cap, answer with the current state right away
+    admitted = bool(wait) and NOTIFIER.start_waiting()
+    deadline = time.monotonic() + (wait if admitted else 0)
+    
+    try:
+        while True:
+            with NOTIFIER.listen(job_id) as changed:
+                job = STAGING_JOBS.get(job_id)
+                if job and job['status'] == 'completed':
+                    output_urls = job.get('output_urls', [])
+                    return jsonify({
+                        'completed': True,
+                        'result': {
+                            'output_urls': output_urls,
+                            'media': MEDIA.media_for(output_urls)
+                        }
+                    })
+                if job and job['status'] == 'failed':
+                    return jsonify({'completed': False, 'failed': True, 'error': job.get('error')})
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return jsonify({'completed': False})
+                # Another worker may have handled the webhook, so re-read the
+                # database at least once a second
+                changed.wait(min(remaining, 1.0))
+    finally:
+        if admitted:
+            NOTIFIER.stop_waiting()
 
 @app.route('/api/recent-stagings')
 def recent_stagings():
-    """Get recent completed stagings"""
-    # Get last 5 completed stagings
-    recent = sorted(
-        COMPLETED_STAGINGS.values(),
-        key=lambda x: x['timestamp'],
-        reverse=True
-    )[:5]
+    """Get recent completed stagings, newest first.
+    
+    Supports ?limit= and ?offset= paging and ?space_type= / ?design_theme=
+    filters.
+    """
+    limit = min(max(request.args.get('limit', 5, type=int), 1), RECENT_STAGINGS_MAX_PAGE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    filters = {
+        name: request.args[name]
+        for name in ('space_type', 'design_theme')
+        if request.args.get(name)
+    }
     
-    return jsonify({'stagings': recent})
+    # Fetch one extra row to know whether another page exists
+    recent = COMPLETED_STAGINGS.recent('completed_at', limit + 1, offset, **filters)
+    
+    for staging in recent:
+        staging['media'] = MEDIA.media_for(staging.get('output_urls') or [])
+    
+    return jsonify({
+        'stagings': recent[:limit],
+        'limit': limit,
+        'offset': offset,
+        'has_more': len(recent) > limit
+    })
 
 @app.route('/api/debug-payload')
 def debug_payload():
@@ -598,23 +952,72 @@ def unique_test_abc123():
 @app.route('/temp-image/<image_id>')
 def serve_temp_image(image_id):
     """Serve temporarily stored images"""
-    # Remove .jpg extension if present
-    image_id = image_id.replace('.jpg', '')
-    
-    if image_id in TEMP_IMAGES:
-        return send_file(
-            io.BytesIO(TEMP_IMAGES[image_id]),
-            mimetype='image/jpeg',
-            as_attachment=False,
-            download_name=f'{image_id}.jpg'
-        )
+    # Remove the file extension if present
+    image_id = os.path.splitext(image_id)[0]
+    
+    image = TEMP_IMAGES.get(image_id)
+    if image is not None:
+        return send_image(image, image_id)
     else:
         return 'Image not found', 404
 
+@app.route('/media/<digest>/<rendition>')
+def serve_media(digest, rendition):
+    """Serve a mirrored output or one of its renditions"""
+    image, key = MEDIA.get(digest, os.path.splitext(rendition)[0])
+    if image is None:
+        return 'Image not found', 404
+    # URLs name the content, so it can be cached for good
+    return send_image(image, key, max_age=365 * 24 * 3600, immutable=True)
+
 # Health check endpoint
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'api_configured': bool(REIMAGINEHOME_API_KEY)})
+    return jsonify({
+        'status': 'healthy',
+        'api_configured': bool(REIMAGINEHOME_API_KEY),
+        'temp_images': TEMP_IMAGES.stats(),
+        'hosting': HOSTING.stats(),
+        'uploads': FINGERPRINTS.stats(),
+        'result_cache': RESULT_CACHE.stats(),
+        'reimagine': REIMAGINE.stats(),
+        'mask_latency': MASK_POLLER.stats.summary(),
+        'admission': ADMISSION.stats(),
+        'webhooks': {**WEBHOOKS.stats(), 'outcomes': WEBHOOK_DEDUPE.stats()},
+        'reconciler': RECONCILER.stats(),
+        'waiters': NOTIFIER.stats(),
+        'media': MEDIA.stats()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Stage latency histograms and counters in Prometheus text format"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/limits', methods=['GET', 'POST'])
+def admin_limits():
+    """Read or change the staging rate limits at runtime.
+    
+    Requires ADMIN_TOKEN as a bearer token; the route does not exist
+    when ADMIN_TOKEN is unset. POST a JSON object with any of
+    rate_per_minute, burst, max_active, max_waiting and wait_timeout.
+    """
+    if not ADMIN_TOKEN:
+        return 'Not found', 404
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    if request.method == 'POST':
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict):
+            return jsonify({'success': False, 'error': 'Expected a JSON object of limits'}), 400
+        try:
+            ADMISSION.configure(**changes)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({'success': True, **ADMISSION.stats()})
 
 # For local development
 if __name__ == '__main__':
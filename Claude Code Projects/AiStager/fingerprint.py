@@ -0,0 +1,142 @@
+"""Near-duplicate detection for uploaded photos.
+
+Agents often upload the same listing photo more than once: re-exported
+from a phone, resized by an email client, or stripped of metadata. The
+bytes differ but the picture does not. Every upload is indexed by the
+digest of its bytes and by a 64-bit perceptual hash (imaging.dhash);
+a new upload whose hash is within a few bits of a stored one, at the same
+aspect ratio and with a near-identical thumbnail, maps to that earlier
+image instead of becoming a new one.
+
+dhash only records which of two neighbouring pixels is brighter, so flat,
+dark or evenly graded photos all hash to (nearly) all zeros or all ones.
+Such low-information hashes never match, and every match must also agree
+on a tiny colour thumbnail, which does see brightness and colour.
+
+The hash is split into four 16-bit bands, each an indexed column. Two
+hashes at most three bits apart must agree on at least one band, so
+looking up the bands finds every match within the default distance
+without scanning the table.
+"""
+import os
+import threading
+import time
+
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', 3))
+# Hashes with fewer set (or unset) bits than this carry too little detail
+PHASH_MIN_BITS = 8
+# Largest RMS difference, per 0-255 channel value, between matching thumbnails
+THUMB_MAX_RMS = float(os.getenv('THUMB_MAX_RMS', 12))
+# Thumbnails flatter than this (standard deviation of brightness) never match
+THUMB_MIN_SPREAD = 6.0
+PHASH_BANDS = 4
+ASPECT_TOLERANCE = 0.02
+MAX_CANDIDATES = 50
+
+# Indexed columns for the fingerprint table
+FINGERPRINT_COLUMNS = tuple(f'band{i}' for i in range(PHASH_BANDS))
+
+
+def hamming(a, b):
+    """Number of differing bits between two hex hashes"""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def thumb_distance(a, b):
+    """RMS difference between two thumbnail signatures"""
+    a, b = bytes.fromhex(a), bytes.fromhex(b)
+    if len(a) != len(b) or not a:
+        return float('inf')
+    return (sum((x - y) ** 2 for x, y in zip(a, b)) / len(a)) ** 0.5
+
+
+def thumb_spread(thumb):
+    """Standard deviation of a thumbnail's brightness"""
+    pixels = bytes.fromhex(thumb)
+    levels = [sum(pixels[i:i + 3]) / 3 for i in range(0, len(pixels), 3)]
+    if not levels:
+        return 0.0
+    mean = sum(levels) / len(levels)
+    return (sum((level - mean) ** 2 for level in levels) / len(levels)) ** 0.5
+
+
+def distinctive(phash, thumb):
+    """Whether an image has enough detail for a perceptual match to mean anything"""
+    bits = bin(int(phash, 16)).count('1')
+    return (PHASH_MIN_BITS <= bits <= len(phash) * 4 - PHASH_MIN_BITS
+            and thumb_spread(thumb) >= THUMB_MIN_SPREAD)
+
+
+def phash_bands(phash):
+    width = len(phash) // PHASH_BANDS
+    return {f'band{i}': phash[i * width:(i + 1) * width] for i in range(PHASH_BANDS)}
+
+
+def _aspect(size):
+    width, height = size
+    return width / height if height else 0.0
+
+
+class FingerprintIndex:
+    """Map uploads to the canonical image they duplicate.
+
+    table is a job_store table keyed by content digest and indexed on
+    FINGERPRINT_COLUMNS; each record names the image_id the digest maps
+    to. exists(image_id) says whether that image is still usable (e.g.
+    not evicted from the image store), so stale entries are skipped.
+    """
+
+    def __init__(self, table, exists, max_distance=PHASH_MAX_DISTANCE):
+        self.table = table
+        self.exists = exists
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self.counts = {'exact': 0, 'similar': 0, 'new': 0}
+
+    def exact(self, digest):
+        """image_id previously stored for these exact bytes, or None"""
+        record = self.table.get(digest)
+        if record and self.exists(record['image_id']):
+            self._count('exact')
+            return record['image_id']
+        return None
+
+    def similar(self, phash, thumb, size):
+        """(image_id, distance) of the closest stored image that looks the same, or None"""
+        if not distinctive(phash, thumb):
+            self._count('new')
+            return None
+        aspect = _aspect(size)
+        best = None
+        for record in self.table.matching(MAX_CANDIDATES, **phash_bands(phash)):
+            if abs(_aspect(record['size']) - aspect) > ASPECT_TOLERANCE:
+                continue
+            # Records from before thumbnails were kept cannot be confirmed
+            if not record.get('thumb') or thumb_distance(thumb, record['thumb']) > THUMB_MAX_RMS:
+                continue
+            distance = hamming(phash, record['phash'])
+            if distance > self.max_distance or (best and distance >= best[1]):
+                continue
+            if self.exists(record['image_id']):
+                best = (record['image_id'], distance)
+        self._count('similar' if best else 'new')
+        return best
+
+    def add(self, digest, image_id, phash, thumb, size):
+        """Record that the upload with this digest is (or maps to) image_id"""
+        self.table[digest] = {
+            'image_id': image_id,
+            'phash': phash,
+            'thumb': thumb,
+            'size': list(size),
+            'added_at': time.time(),
+            **phash_bands(phash)
+        }
+
+    def _count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
@@ -0,0 +1,15 @@
+# Loaded automatically by `gunicorn app:app` (see render.yaml)
+import os
+
+# Job state is in SQLite and local images on shared disk, so any worker can
+# serve any request.
+# cpu_count() reports the host's cores inside a container, not its CPU
+# quota, and every worker carries 32 threads plus its background pools; so
+# default to at most 2 workers and let WEB_CONCURRENCY raise it
+workers = int(os.getenv('WEB_CONCURRENCY', min(2, len(os.sched_getaffinity(0)))))
+
+# Threaded workers, so /api/check-job long-polls hold a thread rather than
+# a whole worker process
+worker_class = 'gthread'
+# Waiting requests may hold at most half of them (MAX_WAITERS in app.py)
+threads = int(os.getenv('GUNICORN_THREADS', 32))
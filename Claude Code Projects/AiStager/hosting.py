@@ -0,0 +1,222 @@
+"""Public hosting for uploaded room photos.
+
+ReimagineHome fetches the photo by URL, so it has to be reachable from the
+internet. Remote hosts (ImgBB, Cloudinary) are raced concurrently and the
+first one to return a URL wins; the local /temp-image route is the fallback
+when none of them succeed in time. Each remote host's latency and failures
+are tracked so slow hosts are tried last and failing hosts are skipped for
+a cooldown period.
+"""
+import base64
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import cloudinary.uploader
+import requests
+
+IMGBB_UPLOAD_URL = os.getenv('IMGBB_UPLOAD_URL', 'https://api.imgbb.com/1/upload')
+HOSTING_TIMEOUT = float(os.getenv('HOSTING_TIMEOUT', 30))
+HOSTING_RACE_TIMEOUT = float(os.getenv('HOSTING_RACE_TIMEOUT', 15))
+HOSTING_COOLDOWN = float(os.getenv('HOSTING_COOLDOWN', 60))
+
+
+class HostingError(Exception):
+    """A provider could not host the image"""
+
+
+class ImgBBProvider:
+    name = 'imgbb'
+
+    def __init__(self, api_key, url=IMGBB_UPLOAD_URL, timeout=HOSTING_TIMEOUT):
+        self.api_key = api_key
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def upload(self, image_bytes, mimetype, name):
+        response = self.session.post(
+            self.url,
+            data={
+                'key': self.api_key,
+                'image': base64.b64encode(image_bytes).decode('ascii'),
+                'name': name
+            },
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise HostingError(f'ImgBB upload failed with status: {response.status_code}')
+        payload = response.json()
+        if not payload.get('success'):
+            raise HostingError(f'ImgBB error: {payload}')
+        return payload['data']['url']
+
+
+class CloudinaryProvider:
+    name = 'cloudinary'
+
+    def __init__(self, folder='aistager', timeout=HOSTING_TIMEOUT):
+        self.folder = folder
+        self.timeout = timeout
+
+    def upload(self, image_bytes, mimetype, name):
+        result = cloudinary.uploader.upload(
+            image_bytes,
+            public_id=name,
+            folder=self.folder,
+            format='jpg',
+            timeout=self.timeout
+        )
+        url = result.get('secure_url')
+        if not url:
+            raise HostingError('Cloudinary returned no URL')
+        return url
+
+
+class LocalProvider:
+    """Serve the image from this app's /temp-image route"""
+    name = 'local'
+
+    def __init__(self, store, extensions):
+        self.store = store
+        self.extensions = extensions
+
+    def upload(self, image_bytes, mimetype, name, base_url):
+        self.store.put(name, image_bytes, mimetype)
+        return f'{base_url}/temp-image/{name}{self.extensions[mimetype]}'
+
+
+class ProviderHealth:
+    """Smoothed latency and failure tracking for one provider"""
+
+    def __init__(self, alpha=0.3, failure_threshold=2, cooldown=HOSTING_COOLDOWN, clock=time.monotonic):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self.latency = None
+        self.error_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.skipped = 0
+        self.cooldown_until = 0.0
+
+    def record(self, ok, elapsed):
+        outcome = 0.0 if ok else 1.0
+        self.error_rate += self.alpha * (outcome - self.error_rate)
+        if ok:
+            self.latency = elapsed if self.latency is None else self.latency + self.alpha * (elapsed - self.latency)
+            self.successes += 1
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                # Back off longer the more often the provider keeps failing
+                streak = self.consecutive_failures - self.failure_threshold
+                self.cooldown_until = self._clock() + self.cooldown * min(2 ** streak, 8)
+
+    def available(self):
+        return self._clock() >= self.cooldown_until
+
+    def score(self):
+        """Expected cost of trying this provider; lower is better"""
+        latency = self.latency if self.latency is not None else 0.0
+        return latency * (1 + 4 * self.error_rate)
+
+    def stats(self):
+        return {
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'successes': self.successes,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'cooling_down': not self.available()
+        }
+
+
+class HostingRacer:
+    """Race remote providers and fall back to local hosting"""
+
+    def __init__(self, providers, fallback, race_timeout=HOSTING_RACE_TIMEOUT):
+        self.providers = list(providers)
+        self.fallback = fallback
+        self.race_timeout = race_timeout
+        self.health = {provider.name: ProviderHealth() for provider in self.providers}
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # Created lazily (and re-created after a fork) like the job engine's
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(4, len(self.providers) * 4),
+                    thread_name_prefix='hosting'
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _candidates(self):
+        with self._lock:
+            candidates = []
+            for provider in self.providers:
+                health = self.health[provider.name]
+                if health.available():
+                    candidates.append(provider)
+                else:
+                    health.skipped += 1
+            return sorted(candidates, key=lambda provider: self.health[provider.name].score())
+
+    def _attempt(self, provider, image_bytes, mimetype, name):
+        started = time.monotonic()
+        try:
+            url = provider.upload(image_bytes, mimetype, name)
+        except Exception:
+            with self._lock:
+                self.health[provider.name].record(False, time.monotonic() - started)
+            raise
+        with self._lock:
+            self.health[provider.name].record(True, time.monotonic() - started)
+        return url
+
+    def host(self, image_bytes, mimetype, name, base_url):
+        """Return (url, provider_name) for a publicly reachable copy of the image"""
+        executor = self._get_executor()
+        pending = {
+            executor.submit(self._attempt, provider, image_bytes, mimetype, name): provider
+            for provider in self._candidates()
+        }
+        deadline = time.monotonic() + self.race_timeout
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    provider = pending.pop(future)
+                    try:
+                        return future.result(), provider.name
+                    except Exception as e:
+                        print(f"{provider.name} upload failed: {e}")
+        finally:
+            # Uploads already in flight cannot be interrupted; they finish in
+            # the background and only update the provider's health
+            for future in pending:
+                future.cancel()
+
+        with self._lock:
+            self.fallbacks += 1
+        return self.fallback.upload(image_bytes, mimetype, name, base_url), self.fallback.name
+
+    def stats(self):
+        with self._lock:
+            return {
+                'providers': {name: health.stats() for name, health in self.health.items()},
+                'fallbacks': self.fallbacks
+            }
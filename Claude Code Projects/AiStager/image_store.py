@@ -0,0 +1,333 @@
+"""Storage for uploaded room photos.
+
+Images are kept as raw decoded bytes (not base64 text) under a byte budget,
+with least-recently-used entries evicted first and entries expiring after
+a TTL. Backends share the small ImageStore interface so app code does not
+care where the bytes live.
+"""
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import Response, request, send_file
+
+# path is set by backends that keep the image in a file, so it can be
+# served with sendfile instead of through Python memory
+StoredImage = namedtuple('StoredImage', ['data', 'mimetype', 'created_at', 'path'], defaults=[None])
+
+EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+    'image/heic': '.heic'
+}
+
+
+class ImageStore:
+    """Interface for image storage backends"""
+
+    def put(self, image_id, data, mimetype='image/jpeg'):
+        raise NotImplementedError
+
+    def get(self, image_id):
+        """Return a StoredImage, or None if missing or expired"""
+        raise NotImplementedError
+
+    def delete(self, image_id):
+        raise NotImplementedError
+
+    def __contains__(self, image_id):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class MemoryImageStore(ImageStore):
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=3600, clock=time.time):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.expirations = 0
+
+    def _remove(self, image_id):
+        image = self._images.pop(image_id)
+        self.bytes_used -= len(image.data)
+        return image
+
+    def _expired(self, image):
+        return self._clock() - image.created_at >= self.ttl
+
+    def put(self, image_id, data, mimetype='image/jpeg'):
+        data = bytes(data)
+        if len(data) > self.max_bytes:
+            raise ValueError(f'Image of {len(data)} bytes exceeds the store budget')
+
+        with self._lock:
+            if image_id in self._images:
+                self._remove(image_id)
+            self._images[image_id] = StoredImage(data, mimetype, self._clock())
+            self.bytes_used += len(data)
+
+            while self.bytes_used > self.max_bytes:
+                oldest_id = next(iter(self._images))
+                evicted = self._remove(oldest_id)
+                if self._expired(evicted):
+                    self.expirations += 1
+                else:
+                    self.evictions += 1
+                    self.evicted_bytes += len(evicted.data)
+
+    def get(self, image_id):
+        with self._lock:
+            image = self._images.get(image_id)
+            if image is None:
+                self.misses += 1
+                return None
+            if self._expired(image):
+                self._remove(image_id)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._images.move_to_end(image_id)
+            self.hits += 1
+            return image
+
+    def delete(self, image_id):
+        with self._lock:
+            if image_id in self._images:
+                self._remove(image_id)
+
+    def __contains__(self, image_id):
+        with self._lock:
+            image = self._images.get(image_id)
+            return image is not None and not self._expired(image)
+
+    def purge_expired(self):
+        """Drop every expired entry; returns how many were removed"""
+        with self._lock:
+            expired = [image_id for image_id, image in self._images.items() if self._expired(image)]
+            for image_id in expired:
+                self._remove(image_id)
+            self.expirations += len(expired)
+            return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'images': len(self._images),
+                'bytes_used': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'expirations': self.expirations
+            }
+
+
+class DiskImageStore(ImageStore):
+    """Content-addressed files in a directory shared by every worker process.
+
+    Each image is one file named by its id (a content hash). The file mtime
+    is the creation time used for the TTL and the atime is bumped on reads
+    for LRU eviction. Reads are memory-mapped, so image bytes sit in the
+    shared page cache rather than in each worker's Python heap.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, ttl=3600, clock=time.time):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.expirations = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _find(self, image_id):
+        """Return (path, mimetype, stat) for a stored image, or None"""
+        if not image_id or '/' in image_id or image_id.startswith('.'):
+            return None
+        for mimetype, extension in EXTENSIONS.items():
+            path = os.path.join(self.directory, image_id + extension)
+            try:
+                return path, mimetype, os.stat(path)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _expired(self, stat):
+        return self._clock() - stat.st_mtime >= self.ttl
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, image_id, data, mimetype='image/jpeg'):
+        if len(data) > self.max_bytes:
+            raise ValueError(f'Image of {len(data)} bytes exceeds the store budget')
+        extension = EXTENSIONS.get(mimetype)
+        if extension is None:
+            raise ValueError(f'Unsupported image type: {mimetype}')
+
+        existing = self._find(image_id)
+        if existing and existing[1] == mimetype and not self._expired(existing[2]):
+            return
+
+        # Write to a temporary file and rename, so other workers never see
+        # a partially written image
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, image_id + extension))
+        if existing and existing[1] != mimetype:
+            self._unlink(existing[0])
+
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_atime, entry.path, stat))
+                total += stat.st_size
+
+        entries.sort()
+        with self._lock:
+            for _, path, stat in entries:
+                if total <= self.max_bytes and not self._expired(stat):
+                    continue
+                self._unlink(path)
+                total -= stat.st_size
+                if self._expired(stat):
+                    self.expirations += 1
+                else:
+                    self.evictions += 1
+                    self.evicted_bytes += stat.st_size
+
+    def get(self, image_id):
+        found = self._find(image_id)
+        if found is None or self._expired(found[2]):
+            with self._lock:
+                self.misses += 1
+                if found is not None:
+                    self.expirations += 1
+            if found is not None:
+                self._unlink(found[0])
+            return None
+
+        path, mimetype, stat = found
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(path, (self._clock(), stat.st_mtime))
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return StoredImage(data, mimetype, stat.st_mtime, path)
+
+    def delete(self, image_id):
+        found = self._find(image_id)
+        if found:
+            self._unlink(found[0])
+
+    def __contains__(self, image_id):
+        found = self._find(image_id)
+        return found is not None and not self._expired(found[2])
+
+    def stats(self):
+        images = 0
+        bytes_used = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.startswith('.') and entry.is_file():
+                    images += 1
+                    bytes_used += entry.stat().st_size
+        with self._lock:
+            return {
+                'backend': 'disk',
+                'images': images,
+                'bytes_used': bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'expirations': self.expirations
+            }
+
+
+def send_image(image, image_id, max_age=3600, immutable=False):
+    """Response for a stored image with its real mimetype, ETag, conditional
+    GET and Range support.
+
+    immutable marks content-addressed URLs whose bytes never change, so
+    browsers skip revalidation entirely.
+
+    File-backed images are streamed straight from disk (sendfile under
+    gunicorn); in-memory images are served from the stored bytes without
+    decoding or copying them. Ids are content hashes, so they are the ETag.
+    """
+    download_name = image_id + EXTENSIONS.get(image.mimetype, '')
+    if image.path:
+        response = send_file(
+            image.path,
+            mimetype=image.mimetype,
+            download_name=download_name,
+            conditional=True,
+            etag=image_id,
+            max_age=max_age
+        )
+    else:
+        response = Response(image.data, mimetype=image.mimetype)
+        response.headers['Content-Disposition'] = f'inline; filename="{download_name}"'
+        response.cache_control.max_age = max_age
+        response.set_etag(image_id)
+        response = response.make_conditional(request, accept_ranges=True, complete_length=len(image.data))
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+def create_image_store(prefix='IMAGE_STORE', max_mb=256, ttl=3600, directory_name='aistager-images'):
+    """Build the image store configured through <prefix>_* variables.
+
+    The arguments are the defaults for variables that are not set.
+    """
+    backend = os.getenv(f'{prefix}_BACKEND', 'disk')
+    max_bytes = int(os.getenv(f'{prefix}_MAX_MB', max_mb)) * 1024 * 1024
+    ttl = float(os.getenv(f'{prefix}_TTL', ttl))
+
+    if backend == 'memory':
+        return MemoryImageStore(max_bytes=max_bytes, ttl=ttl)
+    if backend == 'disk':
+        directory = os.getenv(f'{prefix}_DIR', os.path.join(tempfile.gettempdir(), directory_name))
+        return DiskImageStore(directory, max_bytes=max_bytes, ttl=ttl)
+    raise ValueError(f'Unknown {prefix}_BACKEND: {backend}')
@@ -0,0 +1,115 @@
+"""Ingest-time image normalization.
+
+Phone photos are often 12+ megapixels with EXIF rotation flags and large
+metadata blocks. The staging API does not benefit from that resolution, so
+uploads are decoded once, rotated upright, downscaled to a maximum edge and
+re-encoded without metadata before they are stored and sent upstream.
+"""
+import io
+import os
+import struct
+
+from PIL import Image, ImageOps
+
+MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 2048))
+QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+OUTPUT_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+
+MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+
+class ImageError(ValueError):
+    """Raised when an upload cannot be decoded as an image"""
+
+
+# What Pillow's decoders raise on corrupt input: plugins report malformed
+# headers as SyntaxError, and truncated fields as ValueError or struct.error
+DECODE_ERRORS = (OSError, SyntaxError, ValueError, struct.error, Image.DecompressionBombError)
+
+
+def normalize_image(source, max_edge=MAX_EDGE, quality=QUALITY, output_format=OUTPUT_FORMAT):
+    """Decode, orient, downscale and re-encode an image.
+
+    source is raw bytes or a binary file object. Returns (data, mimetype,
+    info) where info records the original and normalized sizes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        original_bytes = len(source)
+        source = io.BytesIO(source)
+    else:
+        source.seek(0, os.SEEK_END)
+        original_bytes = source.tell()
+        source.seek(0)
+
+    try:
+        image = Image.open(source)
+        original_format = image.format
+        original_size = image.size
+        # draft() lets JPEG decode straight at a reduced scale
+        image.draft('RGB', (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+    except DECODE_ERRORS as e:
+        raise ImageError('Unsupported or corrupt image') from e
+
+    output = io.BytesIO()
+    if output_format == 'WEBP':
+        image.save(output, 'WEBP', quality=quality, method=4)
+    else:
+        output_format = 'JPEG'
+        image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+    data = output.getvalue()
+
+    info = {
+        'original_format': original_format,
+        'original_size': list(original_size),
+        'original_bytes': original_bytes,
+        'size': list(image.size),
+        'bytes': len(data),
+        'phash': dhash(image),
+        'thumb': thumbnail_signature(image)
+    }
+    return data, MIMETYPES[output_format], info
+
+
+def dhash(image, size=8):
+    """Perceptual difference hash: size*size bits as hex.
+
+    Each bit says whether a pixel of a tiny grayscale copy is brighter than
+    its right-hand neighbour, so re-encoding, resizing or stripping
+    metadata leaves the hash (nearly) unchanged.
+    """
+    small = image.convert('L').resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f'{bits:0{size * size // 4}x}'
+
+
+def thumbnail_signature(image, size=4):
+    """A size*size RGB thumbnail as hex.
+
+    dhash only compares neighbouring pixels, so it cannot tell a light
+    photo from a dark one, or one colour from another; near-duplicates are
+    confirmed against this too (see fingerprint.thumb_distance).
+    """
+    small = image.convert('RGB').resize((size, size), Image.Resampling.BOX)
+    return small.tobytes().hex()
+
+
+def fingerprint_image(source):
+    """(phash, thumb, [width, height]) of an upright image, without re-encoding it"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        image = Image.open(source)
+        image.draft('RGB', (256, 256))
+        image = ImageOps.exif_transpose(image)
+        return dhash(image), thumbnail_signature(image), list(image.size)
+    except DECODE_ERRORS as e:
+        raise ImageError('Unsupported or corrupt image') from e
@@ -0,0 +1,238 @@
+"""SQLite-backed job and result records.
+
+One database file (WAL mode) is shared by every gunicorn worker and
+survives restarts and redeploys that keep the disk. Each table stores
+records as JSON plus a few indexed columns copied out of the record, so
+lookups by job id, ReimagineHome job id or completion time use an index.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from cache import TTLCache
+
+
+class JobDatabase:
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+
+    def connect(self):
+        """This thread's connection (sqlite3 connections are not shared across threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=10000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def table(self, name, indexed=(), cache_if=None):
+        return RecordTable(self, name, indexed, cache_if)
+
+
+class RecordTable:
+    """Dict-like table of JSON records keyed by a string id.
+
+    indexed names record fields that get their own indexed column. Records
+    for which cache_if(record) is true (typically finished jobs, which no
+    longer change) are also kept in an in-process read cache.
+    """
+
+    def __init__(self, db, name, indexed=(), cache_if=None):
+        self.db = db
+        self.name = name
+        self.indexed = tuple(indexed)
+        self.cache_if = cache_if
+        self._cache = TTLCache(maxsize=5000, ttl=3600)
+
+        columns = ''.join(f', {column} TEXT' for column in self.indexed)
+        conn = db.connect()
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY{columns}, data TEXT NOT NULL)')
+
+        # Tables created by older code get newly indexed columns backfilled
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({name})')}
+        for column in self.indexed:
+            if column not in existing:
+                conn.execute(f'ALTER TABLE {name} ADD COLUMN {column} TEXT')
+                conn.execute(f"UPDATE {name} SET {column} = json_extract(data, '$.{column}')")
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {name}_{column} ON {name} ({column})')
+
+    def _remember(self, key, record):
+        if self.cache_if and self.cache_if(record):
+            self._cache.set(key, record)
+        else:
+            self._cache.delete(key)
+
+    def get(self, key, default=None):
+        if not isinstance(key, str):
+            return default
+        record = self._cache.get(key)
+        if record is not None:
+            return json.loads(json.dumps(record))
+
+        row = self.db.connect().execute(
+            f'SELECT data FROM {self.name} WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        record = json.loads(row[0])
+        self._remember(key, record)
+        return json.loads(row[0])
+
+    def __getitem__(self, key):
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __setitem__(self, key, record):
+        if not isinstance(key, str) or not key:
+            raise KeyError(key)
+        columns = ('key',) + self.indexed + ('data',)
+        values = [key] + [_column_value(record.get(column)) for column in self.indexed] + [json.dumps(record)]
+        self.db.connect().execute(
+            f'INSERT OR REPLACE INTO {self.name} ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" for _ in columns)})',
+            values
+        )
+        self._remember(key, record)
+
+    def add(self, key, record):
+        """Insert record unless key exists; True if it was inserted.
+
+        Atomic across threads and processes, so it can claim a key.
+        """
+        columns = ('key',) + self.indexed + ('data',)
+        values = [key] + [_column_value(record.get(column)) for column in self.indexed] + [json.dumps(record)]
+        cursor = self.db.connect().execute(
+            f'INSERT OR IGNORE INTO {self.name} ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" for _ in columns)})',
+            values
+        )
+        if cursor.rowcount != 1:
+            return False
+        self._remember(key, record)
+        return True
+
+    def transact(self, key, fn):
+        """Atomically read-modify-write one record across threads and processes.
+
+        fn(record or None) returns (new record or None to delete, result);
+        transact returns result.
+        """
+        conn = self.db.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(f'SELECT data FROM {self.name} WHERE key = ?', (key,)).fetchone()
+            record, result = fn(json.loads(row[0]) if row else None)
+            if record is None:
+                conn.execute(f'DELETE FROM {self.name} WHERE key = ?', (key,))
+            else:
+                columns = ('key',) + self.indexed + ('data',)
+                values = [key] + [_column_value(record.get(column)) for column in self.indexed] + [json.dumps(record)]
+                conn.execute(
+                    f'INSERT OR REPLACE INTO {self.name} ({", ".join(columns)}) '
+                    f'VALUES ({", ".join("?" for _ in columns)})',
+                    values
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if record is None:
+            self._cache.delete(key)
+        else:
+            self._remember(key, record)
+        return result
+
+    def __delitem__(self, key):
+        self._cache.delete(key)
+        self.db.connect().execute(f'DELETE FROM {self.name} WHERE key = ?', (key,))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def find(self, column, value):
+        """First record whose indexed column equals value, or None"""
+        row = self.db.connect().execute(
+            f'SELECT data FROM {self.name} WHERE {self._column(column)} = ? LIMIT 1', (value,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def matching(self, limit, **values):
+        """Records where any of the given indexed columns equals its value"""
+        where = ' OR '.join(f'{self._column(name)} = ?' for name in values)
+        rows = self.db.connect().execute(
+            f'SELECT data FROM {self.name} WHERE {where} LIMIT ?',
+            [*values.values(), limit]
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def recent(self, column, limit, offset=0, **filters):
+        """Records ordered newest first by an indexed column, optionally
+        filtered on other indexed columns (see _filter)"""
+        where, values = self._filter(filters)
+        rows = self.db.connect().execute(
+            f'SELECT data FROM {self.name} WHERE {self._column(column)} IS NOT NULL{where} '
+            f'ORDER BY {column} DESC LIMIT ? OFFSET ?',
+            [*values, limit, offset]
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def due(self, column, before, limit, **filters):
+        """Records whose indexed column sorts before `before`, oldest first"""
+        where, values = self._filter(filters)
+        rows = self.db.connect().execute(
+            f'SELECT data FROM {self.name} WHERE {self._column(column)} < ?{where} '
+            f'ORDER BY {column} LIMIT ?',
+            [before, *values, limit]
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _filter(self, filters):
+        """SQL conditions for filters: a column equals a value, or is one of a tuple/list of values"""
+        where = ''
+        values = []
+        for name, value in filters.items():
+            if isinstance(value, (tuple, list)):
+                where += f' AND {self._column(name)} IN ({", ".join("?" for _ in value)})'
+                values += [_column_value(item) for item in value]
+            else:
+                where += f' AND {self._column(name)} = ?'
+                values.append(value)
+        return where, values
+
+    def trim(self, column, keep):
+        """Delete all but the newest `keep` records by an indexed column"""
+        self.db.connect().execute(
+            f'DELETE FROM {self.name} WHERE key NOT IN '
+            f'(SELECT key FROM {self.name} ORDER BY {self._column(column)} DESC LIMIT ?)',
+            (keep,)
+        )
+
+    def values(self):
+        rows = self.db.connect().execute(f'SELECT data FROM {self.name}').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _column(self, column):
+        if column not in self.indexed:
+            raise ValueError(f'{column} is not an indexed column of {self.name}')
+        return column
+
+    def __len__(self):
+        return self.db.connect().execute(f'SELECT COUNT(*) FROM {self.name}').fetchone()[0]
+
+
+def _column_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
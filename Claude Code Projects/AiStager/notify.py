@@ -0,0 +1,78 @@
+"""In-process wake-ups for code waiting on a job to change"""
+import threading
+from contextlib import contextmanager
+
+
+class Notifier:
+    """Wake-ups keyed by job id, plus a cap on requests blocked waiting for one.
+
+    Long-polls and event streams each hold a server thread while they
+    wait. max_waiters bounds how many may do so at once in this process,
+    so webhooks and uploads always find a free thread; callers past the
+    cap answer with the current state instead of waiting.
+    """
+
+    def __init__(self, max_waiters=None):
+        self._lock = threading.Lock()
+        self._listeners = {}
+        self.max_waiters = max_waiters
+        self._waiters = 0
+        self.turned_away = 0
+
+    @contextmanager
+    def listen(self, key):
+        """Yield an Event that is set when notify(key) is called.
+
+        Register before reading the job's state so a change that lands
+        between the read and the wait is not missed.
+        """
+        event = threading.Event()
+        with self._lock:
+            self._listeners.setdefault(key, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                listeners = self._listeners.get(key)
+                if listeners is not None:
+                    listeners.discard(event)
+                    if not listeners:
+                        del self._listeners[key]
+
+    def start_waiting(self):
+        """Take a waiter slot; False (take none) if max_waiters are already waiting"""
+        with self._lock:
+            if self.max_waiters is not None and self._waiters >= self.max_waiters:
+                self.turned_away += 1
+                return False
+            self._waiters += 1
+            return True
+
+    def stop_waiting(self):
+        with self._lock:
+            self._waiters = max(0, self._waiters - 1)
+
+    @contextmanager
+    def waiter(self):
+        """Yield whether the caller may block waiting; its slot is freed on exit"""
+        admitted = self.start_waiting()
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.stop_waiting()
+
+    def notify(self, key):
+        with self._lock:
+            listeners = list(self._listeners.get(key, ()))
+        for event in listeners:
+            event.set()
+
+    def waiting(self):
+        """Number of active listeners"""
+        with self._lock:
+            return sum(len(listeners) for listeners in self._listeners.values())
+
+    def stats(self):
+        with self._lock:
+            return {'waiters': self._waiters, 'max_waiters': self.max_waiters, 'turned_away': self.turned_away}
@@ -0,0 +1,106 @@
+"""Fallback for webhooks that never arrive.
+
+A background thread periodically looks for jobs that have waited past
+their next_check_at and asks ReimagineHome for their status directly,
+a bounded batch per sweep with a pause between calls. Each sweep slot is
+claimed in a shared table, so with several gunicorn workers only one of
+them sweeps at a time.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from reimagine import ReimagineError, ReimagineUnavailable
+from webhooks import log_event
+
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', 30))
+RECONCILE_BATCH = int(os.getenv('RECONCILE_BATCH', 20))
+RECONCILE_RATE = float(os.getenv('RECONCILE_RATE', 2))  # status calls per second
+RECONCILE_AFTER = float(os.getenv('RECONCILE_AFTER', 90))  # seconds before a job's first check
+RECONCILE_GIVE_UP = float(os.getenv('RECONCILE_GIVE_UP', 30 * 60))
+
+
+def next_check_at(delay=RECONCILE_AFTER):
+    """Timestamp for a job's next_check_at field, delay seconds from now"""
+    return (datetime.now() + timedelta(seconds=delay)).isoformat()
+
+
+class Reconciler:
+    """Sweep stuck jobs through a settle() callback.
+
+    find_due(now, limit) returns jobs due for a check; settle(job) checks
+    one job upstream, updates it and returns an outcome name for the stats.
+    """
+
+    def __init__(self, find_due, settle, leases, interval=RECONCILE_INTERVAL,
+                 batch_size=RECONCILE_BATCH, rate=RECONCILE_RATE, sleep=time.sleep):
+        self.find_due = find_due
+        self.settle = settle
+        self.leases = leases
+        self.interval = interval
+        self.batch_size = batch_size
+        self.rate = rate
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._pid = None
+        self.sweeps = 0
+        self.outcomes = {}
+
+    def start(self):
+        """Start the sweep thread in this process if it is not running yet"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='reconciler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._sleep(self.interval)
+            try:
+                if self._claim_slot():
+                    self.sweep()
+            except Exception as e:
+                log_event('reconcile_failed', error=str(e))
+
+    def _claim_slot(self):
+        slot = int(time.time() // self.interval)
+        if not self.leases.add(f'sweep:{slot}', {'claimed_at': datetime.now().isoformat(), 'pid': os.getpid()}):
+            return False
+        if slot % 100 == 0:
+            self.leases.trim('claimed_at', 100)
+        return True
+
+    def sweep(self):
+        """Check one batch of due jobs; returns the number checked"""
+        jobs = self.find_due(datetime.now().isoformat(), self.batch_size)
+        checked = 0
+        for job in jobs:
+            if checked:
+                self._sleep(1 / self.rate)
+            try:
+                outcome = self.settle(job)
+            except ReimagineUnavailable:
+                # Leave the rest for a later sweep once the breaker closes
+                self._count('unavailable')
+                break
+            except ReimagineError as e:
+                outcome = 'error'
+                log_event('reconcile_error', job_id=job.get('job_id'), error=str(e))
+            checked += 1
+            self._count(outcome)
+
+        with self._lock:
+            self.sweeps += 1
+        if jobs:
+            log_event('reconcile_sweep', due=len(jobs), checked=checked)
+        return checked
+
+    def _count(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'sweeps': self.sweeps, 'outcomes': dict(self.outcomes)}
@@ -0,0 +1,83 @@
+"""Reuse of earlier stagings for repeated requests.
+
+Staging the same photo with the same space_type and design_theme again
+would re-run the whole paid pipeline for an equivalent result. Each
+submitted staging is recorded here under (image id, space_type,
+design_theme); a repeat request is answered with that job instead,
+finished or still running, unless it asks for a fresh one with force.
+
+Image ids are content hashes mapped through the fingerprint index, so a
+re-encoded copy of a photo hits the same entry. Entries live in a shared
+job_store table indexed on cached_at, expire after ttl seconds, and only
+the newest max_entries are kept.
+"""
+import os
+import threading
+import time
+
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', 7 * 24 * 3600))
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 5000))
+
+
+class ResultCache:
+    """Map staging parameters to the job that produced them.
+
+    resolve(entry) turns a stored entry into the response for a repeat
+    request, or returns None when the job can no longer be reused (it
+    failed or is gone), which drops the entry.
+    """
+
+    def __init__(self, table, resolve, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_SIZE,
+                 clock=time.time):
+        self.table = table
+        self.resolve = resolve
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stores = 0
+        self.counts = {'hits': 0, 'misses': 0, 'expired': 0, 'stale': 0, 'forced': 0}
+
+    @staticmethod
+    def key(image_id, space_type, design_theme):
+        return f"{image_id}:{space_type or ''}:{design_theme or ''}".lower()
+
+    def get(self, image_id, space_type, design_theme):
+        """resolve() of the entry for these parameters, or None"""
+        key = self.key(image_id, space_type, design_theme)
+        entry = self.table.get(key)
+        if entry is None:
+            self._count('misses')
+            return None
+        if self._clock() - entry['cached_at'] > self.ttl:
+            del self.table[key]
+            self._count('expired')
+            return None
+        resolved = self.resolve(entry)
+        if resolved is None:
+            del self.table[key]
+            self._count('stale')
+            return None
+        self._count('hits')
+        return resolved
+
+    def put(self, image_id, space_type, design_theme, **entry):
+        """Record the job now serving these parameters"""
+        self.table[self.key(image_id, space_type, design_theme)] = {**entry, 'cached_at': self._clock()}
+        with self._lock:
+            self._stores += 1
+            trim = self._stores % 100 == 0
+        if trim:
+            self.table.trim('cached_at', self.max_entries)
+
+    def skipped(self):
+        """Count a request that bypassed the cache with force"""
+        self._count('forced')
+
+    def _count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, 'ttl': self.ttl, 'max_entries': self.max_entries}
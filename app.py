@@ -1,27 +1,158 @@
 import os
 import time
-import requests
 import base64
-from flask import Flask, request, jsonify, render_template_string, send_file
+from flask import Flask, Response, request, jsonify, render_template_string
 from flask_cors import CORS
 from dotenv import load_dotenv
-from PIL import Image
-import io
 import hashlib
+import atexit
+import hmac
+import math
 import json
+import tempfile
+import uuid
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from jobs import JobEngine, StagingError
+from reimagine import ReimagineClient, ReimagineError, ReimagineUnavailable
+from polling import BackoffPoller, PollTimeout
+from cache import SingleFlight, TTLCache
+from fingerprint import FINGERPRINT_COLUMNS, FingerprintIndex
+from image_store import create_image_store, send_image
+from media import MediaMirror
+from job_store import JobDatabase
+from imaging import normalize_image
+from notify import Notifier
+from ratelimit import AdmissionControl, RateLimited
+from result_cache import ResultCache
+from tracing import Metrics
+from reconcile import RECONCILE_AFTER, RECONCILE_GIVE_UP, Reconciler, next_check_at
+from webhooks import (WebhookDeduper, WebhookQueue, extract_output_urls, is_final,
+                      log_event, merge_results, webhook_result)
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+# Render terminates requests at a proxy; trust its X-Forwarded-For so
+# rate limits key on the real client address
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('PROXY_HOPS', 1)))
 
 # Get API key from environment
 REIMAGINEHOME_API_KEY = os.getenv('REIMAGINEHOME_API_KEY')
 
-# Store uploaded images and results in memory
-UPLOADED_IMAGES = {}
-STAGING_RESULTS = {}
+# Images, job records and webhook results are kept on local disk so every
+# gunicorn worker sees the same state and it survives restarts
+STATE_DIR = os.getenv('STATE_DIR', os.path.join(tempfile.gettempdir(), 'aistager'))
+IMAGE_STORE = create_image_store()
+JOB_DB = JobDatabase(os.getenv('JOB_DB_PATH', os.path.join(STATE_DIR, 'jobs.db')))
+# Progress callbacks are merged into results, so only final ones are cached
+# Not cached in-process: a later callback may still add outputs to a final
+# result, and another worker may be the one that stores them
+STAGING_RESULTS = JOB_DB.table('results')
+# Staged outputs are mirrored locally with thumbnail and web renditions
+MEDIA = MediaMirror(
+    create_image_store('MEDIA_STORE', max_mb=1024, ttl=30 * 24 * 3600, directory_name='aistager-media'),
+    JOB_DB.table('media', cache_if=bool)
+)
+# Re-encoded or resized copies of a photo map to the image first uploaded
+FINGERPRINTS = FingerprintIndex(
+    JOB_DB.table('fingerprints', indexed=FINGERPRINT_COLUMNS),
+    exists=lambda image_id: image_id in IMAGE_STORE
+)
+FINISHED = ('completed', 'failed')
+# Statuses of a job still in its worker's hands, before generate_image is submitted
+STARTING = ('queued', 'masking', 'generating')
+
+# Binary uploads are hashed and spooled in chunks; bigger ones go to disk
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_MB', 25)) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+
+STAGING_BATCHES = JOB_DB.table('batches')
+MAX_BATCH_JOBS = int(os.getenv('MAX_BATCH_JOBS', 200))
+MAX_PARALLEL_VARIANTS = 4
+# Each variant is a paid generate_image call
+MAX_VARIANTS = int(os.getenv('MAX_VARIANTS', 8))
+
+# Wakes /events streams when a job changes or its webhook arrives. At most
+# half of a worker's threads may be held by streams and long-polls, so
+# webhooks, uploads and /api/stage always get a thread.
+NOTIFIER = Notifier(max_waiters=int(os.getenv('MAX_WAITERS', int(os.getenv('GUNICORN_THREADS', 32)) // 2)))
+EVENTS_TIMEOUT = float(os.getenv('EVENTS_TIMEOUT', 300))
+EVENTS_RECHECK = 1.0
+EVENTS_KEEPALIVE = 15.0
+MAX_LONG_POLL = 30.0
+
+# Webhooks are acknowledged right away and processed in the background
+WEBHOOKS = WebhookQueue(maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)))
+atexit.register(WEBHOOKS.drain)
+# Repeated deliveries of the same callback are dropped before queueing
+WEBHOOK_DEDUPE = WebhookDeduper(JOB_DB.table('webhook_deliveries', indexed=('received_at',)))
+
+# Staging pipelines run here instead of on the request thread. Batch jobs
+# get their own pool: each holds a thread while it waits on its masks, so a
+# listing fans out across BATCH_WORKERS rooms at once, and /api/stage jobs
+# never queue behind a batch.
+STAGING_WORKERS = int(os.getenv('STAGING_WORKERS', 4))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 16))
+JOBS = JobEngine(
+    max_workers=STAGING_WORKERS,
+    pools={'batch': BATCH_WORKERS},
+    records=JOB_DB.table(
+        'jobs',
+        indexed=('reimagine_job_id', 'status', 'created_at', 'completed_at', 'next_check_at'),
+        cache_if=lambda job: job['status'] in FINISHED
+    ),
+    on_update=NOTIFIER.notify,
+    # A starting job whose lease lapses lost its worker (see reconcile_job)
+    lease=float(os.getenv('STAGING_JOB_LEASE', 120))
+)
+
+# One pooled session shared by every job
+REIMAGINE = ReimagineClient(REIMAGINEHOME_API_KEY, pool_size=(STAGING_WORKERS + BATCH_WORKERS) * 2)
+
+# Mask status polling; the first check adapts to observed mask latency
+MASK_POLLER = BackoffPoller(
+    initial_delay=float(os.getenv('MASK_POLL_INITIAL_DELAY', 0.5)),
+    max_delay=float(os.getenv('MASK_POLL_MAX_DELAY', 8)),
+    deadline=float(os.getenv('MASK_POLL_DEADLINE', 40))
+)
+
+# Masks depend only on the image, so they are cached by image content hash
+# and reused when the same photo is staged with another style or room type
+MASK_CACHE = TTLCache(
+    maxsize=int(os.getenv('MASK_CACHE_SIZE', 500)),
+    ttl=float(os.getenv('MASK_CACHE_TTL', 6 * 3600))
+)
+MASK_FLIGHTS = SingleFlight()
+
+# Per-stage latency histograms and counters for /metrics, summed across workers
+METRICS = Metrics(store=JOB_DB.table('metrics', indexed=('updated_at',)))
+
+# Per-client rate limits and a cap on in-flight stagings. The limits, the
+# clients' buckets and the in-flight count are kept in the job database, so
+# they hold across all workers and /api/admin/limits changes reach each one.
+ADMISSION = AdmissionControl(
+    defaults={
+        'rate_per_minute': float(os.getenv('STAGE_RATE_PER_MINUTE', 30)),
+        'burst': float(os.getenv('STAGE_BURST', 10)),
+        'max_active': int(os.getenv('STAGE_MAX_ACTIVE', MAX_BATCH_JOBS)),
+        'max_waiting': int(os.getenv('STAGE_MAX_WAITING', 50)),
+        'wait_timeout': float(os.getenv('STAGE_WAIT_TIMEOUT', 10))
+    },
+    store=JOB_DB.table('settings'),
+    buckets=JOB_DB.table('rate_buckets', indexed=('updated_at',)),
+    slots=JOB_DB.table('admission')
+)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Callers sending one of these as X-API-Key get their own rate-limit bucket;
+# any other header is ignored and the caller is limited by address
+STAGE_API_KEYS = [key.strip() for key in os.getenv('STAGE_API_KEYS', '').split(',') if key.strip()]
+
+# Shown while ReimagineHome's circuit breakers are open
+UNAVAILABLE_MESSAGE = 'The staging service is temporarily unavailable. Please try again shortly.'
 
 print(f"ReimagineHome API configured: {'Yes' if REIMAGINEHOME_API_KEY else 'No'}")
 
@@ -96,33 +227,32 @@ HTML_TEMPLATE = '''
         document.getElementById('fileInput').addEventListener('change', async (e) => {
             const file = e.target.files[0];
             if (file) {
-                const reader = new FileReader();
-                reader.onload = async (event) => {
-                    document.getElementById('preview').src = event.target.result;
-                    document.getElementById('preview').classList.remove('hidden');
-                    
-                    const uploadStatus = document.getElementById('uploadStatus');
-                    uploadStatus.innerHTML = '<p class="text-sm text-blue-600">Uploading image...</p>';
+                document.getElementById('preview').src = URL.createObjectURL(file);
+                document.getElementById('preview').classList.remove('hidden');
+                
+                const uploadStatus = document.getElementById('uploadStatus');
+                uploadStatus.innerHTML = '<p class="text-sm text-blue-600">Uploading image...</p>';
+                
+                // Send the file as-is; no base64 inflation
+                const formData = new FormData();
+                formData.append('image', file);
+                
+                try {
+                    const response = await fetch('/upload-image', {
+                        method: 'POST',
+                        body: formData
+                    });
                     
-                    try {
-                        const response = await fetch('/upload-image', {
-                            method: 'POST',
-                            headers: { 'Content-Type': 'application/json' },
-                            body: JSON.stringify({ image: event.target.result })
-                        });
-                        
-                        const data = await response.json();
-                        if (data.success) {
-                            imageId = data.image_id;
-                            uploadStatus.innerHTML = '<p class="text-sm text-green-600">✓ Image uploaded!</p>';
-                        } else {
-                            uploadStatus.innerHTML = '<p class="text-sm text-red-600">Upload failed</p>';
-                        }
-                    } catch (error) {
-                        uploadStatus.innerHTML = '<p class="text-sm text-red-600">Upload error</p>';
+                    const data = await response.json();
+                    if (data.success) {
+                        imageId = data.image_id;
+                        uploadStatus.innerHTML = '<p class="text-sm text-green-600">✓ Image uploaded!</p>';
+                    } else {
+                        uploadStatus.innerHTML = `<p class="text-sm text-red-600">Upload failed: ${data.error}</p>`;
                     }
-                };
-                reader.readAsDataURL(file);
+                } catch (error) {
+                    uploadStatus.innerHTML = '<p class="text-sm text-red-600">Upload error</p>';
+                }
             }
         });
         
@@ -173,8 +303,8 @@ HTML_TEMPLATE = '''
                         </div>
                     `;
                     
-                    // Start polling for results
-                    pollForResults(currentJobId);
+                    // Wait for the results to be pushed to us
+                    watchJob(currentJobId);
                 } else {
                     status.innerHTML = `
                         <div class="bg-red-50 p-4 rounded">
@@ -191,34 +321,83 @@ HTML_TEMPLATE = '''
             }
         });
         
-        // Poll for results
+        function showFailure(error) {
+            document.getElementById('results').innerHTML = `
+                <div class="bg-red-50 p-4 rounded">
+                    <p class="text-red-800 font-semibold">✗ Error</p>
+                    <p class="text-sm text-red-600 mt-1">${error}</p>
+                </div>
+            `;
+        }
+        
+        function showStillProcessing() {
+            document.getElementById('results').innerHTML = `
+                <div class="bg-yellow-50 p-4 rounded">
+                    <p class="text-yellow-800">Still processing...</p>
+                    <p class="text-sm text-yellow-600 mt-1">Large images may take longer. Check back in a moment.</p>
+                </div>
+            `;
+        }
+        
+        // Results are pushed over server-sent events as soon as the webhook
+        // arrives; browsers without EventSource fall back to polling
+        function watchJob(jobId) {
+            if (!window.EventSource) {
+                pollForResults(jobId);
+                return;
+            }
+            
+            const source = new EventSource(`/events/${jobId}`);
+            const timeout = setTimeout(() => {
+                source.close();
+                showStillProcessing();
+            }, 5 * 60 * 1000);
+            
+            source.onmessage = (event) => {
+                const data = JSON.parse(event.data);
+                if (data.found) {
+                    clearTimeout(timeout);
+                    source.close();
+                    displayResults(data.result);
+                } else if (data.status === 'failed') {
+                    clearTimeout(timeout);
+                    source.close();
+                    showFailure(data.error);
+                }
+            };
+            source.onerror = () => {
+                // EventSource reconnects on its own unless the stream is unusable
+                if (source.readyState === EventSource.CLOSED) {
+                    clearTimeout(timeout);
+                    pollForResults(jobId);
+                }
+            };
+        }
+        
+        // Long-poll for results; each request returns as soon as the job
+        // finishes, or at once when the server is busy, so polls are spaced
         async function pollForResults(jobId) {
-            const maxAttempts = 30; // 60 seconds
-            let attempts = 0;
+            const deadline = Date.now() + 5 * 60 * 1000;
             
-            const interval = setInterval(async () => {
-                attempts++;
-                
+            while (Date.now() < deadline) {
+                const sent = Date.now();
                 try {
-                    const response = await fetch(`/check-result/${jobId}`);
+                    const response = await fetch(`/check-result/${jobId}?wait=25`);
                     const data = await response.json();
                     
                     if (data.found) {
-                        clearInterval(interval);
                         displayResults(data.result);
-                    } else if (attempts >= maxAttempts) {
-                        clearInterval(interval);
-                        document.getElementById('results').innerHTML = `
-                            <div class="bg-yellow-50 p-4 rounded">
-                                <p class="text-yellow-800">Still processing...</p>
-                                <p class="text-sm text-yellow-600 mt-1">Large images may take longer. Check back in a moment.</p>
-                            </div>
-                        `;
+                        return;
+                    } else if (data.status === 'failed') {
+                        showFailure(data.error);
+                        return;
                     }
                 } catch (error) {
                     console.error('Poll error:', error);
                 }
-            }, 2000);
+                await new Promise(resolve => setTimeout(resolve, Math.max(0, sent + 2000 - Date.now())));
+            }
+            showStillProcessing();
         }
         
         function displayResults(result) {
@@ -234,18 +413,18 @@ HTML_TEMPLATE = '''
             stagedResults.classList.remove('hidden');
             resultImages.innerHTML = '';
             
-            if (result.output_urls && result.output_urls.length > 0) {
-                result.output_urls.forEach((url, index) => {
-                    resultImages.innerHTML += `
-                        <div>
-                            <img src="${url}" class="w-full rounded shadow" alt="Staged room">
-                            <a href="${url}" target="_blank" class="text-sm text-blue-600 hover:underline mt-2 inline-block">
-                                View full size
-                            </a>
-                        </div>
-                    `;
-                });
-            }
+            // Prefer our mirrored renditions; fall back to ReimagineHome's URLs
+            const media = result.media || (result.output_urls || []).map(url => ({ url }));
+            media.forEach(item => {
+                resultImages.innerHTML += `
+                    <div>
+                        <img src="${item.web || item.url}" class="w-full rounded shadow" alt="Staged room">
+                        <a href="${item.original || item.url}" target="_blank" class="text-sm text-blue-600 hover:underline mt-2 inline-block">
+                            View full size
+                        </a>
+                    </div>
+                `;
+            });
         }
     </script>
 </body>
@@ -256,153 +435,857 @@ HTML_TEMPLATE = '''
 def index():
     return render_template_string(HTML_TEMPLATE)
 
+def spool_upload(stream):
+    """Copy an upload stream into a temporary file in chunks, hashing as it goes.
+    
+    Returns (file, md5 hexdigest), or (None, None) if the upload is larger
+    than MAX_UPLOAD_BYTES.
+    """
+    digest = hashlib.md5()
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    size = 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            spooled.close()
+            return None, None
+        digest.update(chunk)
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled, digest.hexdigest()
+
+def store_upload(digest, source):
+    """Normalize and store an upload unless the same image is already stored.
+    
+    Exact copies are found by digest; re-encoded or resized copies by
+    perceptual hash. Either way the earlier image_id is returned, so its
+    cached masks are reused.
+    """
+    image_id = FINGERPRINTS.exact(digest)
+    if image_id is None and digest[:12] in IMAGE_STORE:
+        image_id = digest[:12]
+    if image_id:
+        return jsonify({'success': True, 'image_id': image_id, 'duplicate': 'exact'})
+    
+    try:
+        with METRICS.span('upload_decode'):
+            normalized, mimetype, info = normalize_image(source)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    
+    match = FINGERPRINTS.similar(info['phash'], info['thumb'], info['size'])
+    if match:
+        image_id, distance = match
+        FINGERPRINTS.add(digest, image_id, info['phash'], info['thumb'], info['size'])
+        print(f"Image {digest[:12]} matches {image_id} ({distance} bits apart)")
+        return jsonify({'success': True, 'image_id': image_id, 'duplicate': 'similar', 'image': info})
+    
+    image_id = digest[:12]
+    IMAGE_STORE.put(image_id, normalized, mimetype)
+    FINGERPRINTS.add(digest, image_id, info['phash'], info['thumb'], info['size'])
+    print(f"Image {image_id}: {info['original_size']} {info['original_bytes']} bytes -> "
+          f"{info['size']} {info['bytes']} bytes")
+    return jsonify({'success': True, 'image_id': image_id, 'image': info})
+
 @app.route('/upload-image', methods=['POST'])
 def upload_image():
+    """Accept a photo as multipart form data, a raw image body, or base64 JSON"""
+    too_large = jsonify({'success': False, 'error': 'Image is too large'}), 413
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES * 2:
+        return too_large
+    
+    # Binary uploads are read in chunks and never held as one Python string
+    if request.mimetype == 'multipart/form-data' or request.mimetype.startswith('image/') \
+            or request.mimetype == 'application/octet-stream':
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('image')
+            if not upload:
+                return jsonify({'success': False, 'error': 'No image provided'})
+            stream = upload.stream
+        else:
+            stream = request.stream
+        
+        spooled, digest = spool_upload(stream)
+        if spooled is None:
+            return too_large
+        with spooled:
+            if spooled.seek(0, os.SEEK_END) == 0:
+                return jsonify({'success': False, 'error': 'No image provided'})
+            spooled.seek(0)
+            # Same id scheme as the JSON route: md5 of the image bytes
+            return store_upload(digest, spooled)
+    
+    # Base64 data URL in JSON, kept for older clients
     data = request.json
     image_data = data.get('image')
     
     if not image_data:
         return jsonify({'success': False, 'error': 'No image provided'})
     
-    image_id = hashlib.md5(image_data.encode()).hexdigest()[:12]
-    UPLOADED_IMAGES[image_id] = image_data
+    base64_data = image_data.split(',')[1] if ',' in image_data else image_data
+    try:
+        image_bytes = base64.b64decode(base64_data)
+    except ValueError:
+        image_bytes = None
+    if not image_bytes:
+        return jsonify({'success': False, 'error': 'Invalid image data'})
+    if len(image_bytes) > MAX_UPLOAD_BYTES:
+        return too_large
     
-    return jsonify({'success': True, 'image_id': image_id})
+    # Ids are content hashes of the decoded upload, so the same photo always
+    # gets the same id no matter how it was encoded
+    return store_upload(hashlib.md5(image_bytes).hexdigest(), image_bytes)
 
 @app.route('/image/<image_id>')
 def serve_image(image_id):
-    if image_id not in UPLOADED_IMAGES:
+    image_id = os.path.splitext(image_id)[0]
+    image = IMAGE_STORE.get(image_id)
+    if image is None:
         return 'Image not found', 404
     
-    image_data = UPLOADED_IMAGES[image_id]
-    base64_data = image_data.split(',')[1] if ',' in image_data else image_data
-    image_bytes = base64.b64decode(base64_data)
+    return send_image(image, image_id)
+
+def record_result(result_key, result, job=None):
+    """Merge a webhook result into the one stored under ReimagineHome's job id.
     
-    return send_file(
-        io.BytesIO(image_bytes),
-        mimetype='image/jpeg',
-        as_attachment=False,
-        download_name=f'{image_id}.jpg'
-    )
+    job is the staging job the result belongs to, if known; only those
+    results have their outputs mirrored. Returns False when the callback
+    changed nothing (a repeat, or progress arriving after the final result).
+    """
+    def merge(current):
+        merged, outcome = merge_results(current and current['data'], result)
+        if merged is None:
+            return current, (None, outcome)
+        return {'timestamp': datetime.now().isoformat(), 'data': merged}, (merged, outcome)
+    
+    # One transaction, so callbacks handled at once by different workers
+    # (or the reconciler) cannot overwrite each other's merge
+    merged, outcome = STAGING_RESULTS.transact(result_key, merge)
+    WEBHOOK_DEDUPE.count(outcome)
+    METRICS.inc('events_total', kind='webhook', outcome=outcome)
+    if merged is None:
+        return False
+    if is_final(merged) and job:
+        MEDIA.mirror(merged['output_urls'])
+    NOTIFIER.notify(result_key)
+    return True
+
+def result_is_ours(job, result_key):
+    """Whether result_key is one of job's ReimagineHome ids, or may yet become one"""
+    if not job:
+        return False
+    if job['status'] in STARTING:
+        # Generation ids are recorded once the job is submitted
+        return True
+    if 'design_themes' in job:
+        return result_key in {variant.get('reimagine_job_id') for variant in job.get('variants', [])}
+    return job.get('reimagine_job_id') in (None, result_key)
+
+def final_result(result_key):
+    """The stored result for a ReimagineHome job id once it is final, else None"""
+    result = STAGING_RESULTS.get(result_key)
+    if result and is_final(result['data']):
+        return result
+    return None
+
+def mark_completed(job_id):
+    """Record completion on the job once all of its results are in"""
+    job = JOBS.get(job_id)
+    if job and job['status'] == 'submitted' and lookup_job(job_id)['found']:
+        now = datetime.now()
+        JOBS.update(job_id, status='completed', completed_at=now.isoformat())
+        METRICS.record('total', (now - datetime.fromisoformat(job['created_at'])).total_seconds(), job_id)
+
+def accept_webhook(scope, fn, *args):
+    """Queue a webhook for background processing and acknowledge it.
+    
+    A body already accepted for the same scope is acknowledged and dropped.
+    """
+    claim = WEBHOOK_DEDUPE.claim(scope, request.get_data())
+    if claim is None:
+        return jsonify({'status': 'success', 'duplicate': True})
+    if not WEBHOOKS.submit(fn, *args):
+        WEBHOOK_DEDUPE.release(claim)
+        log_event('webhook_rejected', reason='queue_full')
+        response = jsonify({'status': 'error', 'error': 'Busy, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    return jsonify({'status': 'success'})
 
 @app.route('/webhook/reimaginehome', methods=['POST'])
 def webhook():
     """Receive results from ReimagineHome"""
-    data = request.json
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'error': 'Expected a JSON object'}), 400
+    body = data.get('data')
+    if not (data.get('job_id') or (isinstance(body, dict) and body.get('job_id'))):
+        # Nothing to key the result on
+        return jsonify({'status': 'success'})
+    return accept_webhook('legacy', process_legacy_webhook, data)
+
+def process_legacy_webhook(data):
+    result = webhook_result(data)
+    result_key = str(result['job_id'])
+    # Older stagings used this route; find their job by ReimagineHome id
+    job = JOBS.jobs.find('reimagine_job_id', result_key)
+    if not record_result(result_key, result, job):
+        return
     
-    if data and 'job_id' in data:
-        job_id = data['job_id']
-        STAGING_RESULTS[job_id] = {
-            'timestamp': datetime.now().isoformat(),
-            'data': data
-        }
+    if job:
+        mark_completed(job['job_id'])
+    log_event('webhook', route='legacy', result_key=result_key,
+              job_id=job and job['job_id'], outputs=len(result['output_urls']))
+
+@app.route('/webhook/reimaginehome/<job_id>', methods=['POST'])
+def job_webhook(job_id):
+    """Receive results for one of our staging jobs and wake its waiters"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'error': 'Expected a JSON object'}), 400
+    return accept_webhook(f'job:{job_id}', process_job_webhook, job_id, data)
+
+def process_job_webhook(job_id, data):
+    result = webhook_result(data)
+    job = JOBS.get(job_id) or {}
+    # The URL names our job, so its recorded ReimagineHome id wins; variant
+    # jobs have one id per theme, named by the payload
+    if 'design_themes' in job:
+        result_key = result['job_id']
+    else:
+        result_key = job.get('reimagine_job_id') or result['job_id']
     
-    return jsonify({'status': 'success'})
+    if result_key:
+        result_key = str(result_key)
+        if not record_result(result_key, result, job if result_is_ours(job, result_key) else None):
+            return
+        if job.get('submitted_at') and is_final(result):
+            waited = datetime.now() - datetime.fromisoformat(job['submitted_at'])
+            METRICS.record('webhook_wait', waited.total_seconds(), job_id)
+        if job and 'design_themes' not in job and not job.get('reimagine_job_id'):
+            JOBS.update(job_id, reimagine_job_id=result_key)
+        mark_completed(job_id)
+        NOTIFIER.notify(job_id)
+    log_event('webhook', job_id=job_id, known=bool(job), result_key=result_key,
+              outputs=len(result['output_urls']))
+
+def lookup_job(job_id):
+    """Current state of a job as reported to clients"""
+    job = JOBS.get(job_id)
+    if job:
+        if job['status'] == 'failed':
+            return {'found': False, 'status': 'failed', 'error': job['error']}
+        if 'design_themes' in job:
+            return lookup_variants(job)
+        result = final_result(job.get('reimagine_job_id'))
+        if result:
+            return {'found': True, 'status': 'completed', 'result': with_media(result['data'])}
+        return {'found': False, 'status': job['status']}
+    
+    # ReimagineHome job ids are still accepted directly
+    result = final_result(job_id)
+    if result:
+        return {'found': True, 'result': with_media(result['data'])}
+    return {'found': False}
+
+def reconcile_job(job):
+    """Ask ReimagineHome about a submitted job whose webhook has not arrived.
+    
+    A job that is due while still starting was orphaned by a worker
+    restart, since a live worker keeps renewing its lease; it is failed.
+    """
+    job_id = job['job_id']
+    if job['status'] in STARTING:
+        return fail_orphaned(job_id)
+    
+    checks = job.get('reconcile_checks', 0) + 1
+    # Reschedule first so a failing check cannot keep the job at the front
+    JOBS.update(job_id, reconcile_checks=checks,
+                next_check_at=next_check_at(min(RECONCILE_AFTER * checks, 600)))
+    
+    if 'design_themes' in job:
+        result_keys = [v['reimagine_job_id'] for v in job.get('variants', []) if v.get('reimagine_job_id')]
+    else:
+        result_keys = [job['reimagine_job_id']] if job.get('reimagine_job_id') else []
+    
+    for result_key in result_keys:
+        if final_result(result_key):
+            continue
+        try:
+            with METRICS.span('generation_status', job_id):
+                result = webhook_result(REIMAGINE.get_generation_status(result_key))
+        except ReimagineUnavailable:
+            raise
+        except ReimagineError as e:
+            log_event('reconcile_error', job_id=job_id, result_key=result_key, error=str(e))
+            continue
+        if is_final(result):
+            record_result(result_key, {**result, 'job_id': result['job_id'] or result_key}, job)
+    
+    mark_completed(job_id)
+    if JOBS.get(job_id)['status'] == 'completed':
+        return 'completed'
+    
+    age = (datetime.now() - datetime.fromisoformat(job['created_at'])).total_seconds()
+    if age > RECONCILE_GIVE_UP:
+        JOBS.update(job_id, status='failed', error='Staging timed out. Please try again.')
+        return 'timed_out'
+    return 'pending'
+
+def fail_orphaned(job_id):
+    """Fail a starting job whose worker went away, unless it has moved on since"""
+    job = JOBS.get(job_id)
+    if not job or job['status'] not in STARTING or job['next_check_at'] > datetime.now().isoformat():
+        return 'pending'
+    JOBS.update(job_id, status='failed', error='Staging was interrupted by a server restart. Please try again.')
+    log_event('job_orphaned', job_id=job_id, status=job['status'])
+    return 'orphaned'
+
+# Settles submitted jobs whose webhook was lost, and starting jobs whose worker died
+RECONCILER = Reconciler(
+    find_due=lambda now, limit: JOBS.jobs.due('next_check_at', now, limit, status=STARTING + ('submitted',)),
+    settle=reconcile_job,
+    leases=JOB_DB.table('sweeps', indexed=('claimed_at',))
+)
+
+@app.before_request
+def start_reconciler():
+    RECONCILER.start()
+
+def reuse_staging(entry):
+    """Answer for a repeat of a staging that finished or is still running, else None.
+    
+    A job not yet submitted after REUSE_STARTING_FOR seconds counts as
+    stale: its worker may have died before the reconciler failed it.
+    """
+    job = JOBS.get(entry['job_id'])
+    if job and job['status'] not in ('submitted', 'completed'):
+        age = (datetime.now() - datetime.fromisoformat(job['created_at'])).total_seconds()
+        if age > REUSE_STARTING_FOR:
+            return None
+    state = lookup_job(entry['job_id'])
+    if not state['found'] and state.get('status') in (None, 'failed'):
+        return None
+    response = {
+        'success': True,
+        'job_id': entry['job_id'],
+        'cached': True,
+        'message': 'Staging already done' if state['found'] else 'Staging in progress'
+    }
+    if state['found']:
+        response['result'] = state['result']
+    return response
+
+# Repeats of a staging (same image, space_type and design_theme) reuse its job
+REUSE_STARTING_FOR = float(os.getenv('REUSE_STARTING_FOR', 180))
+RESULT_CACHE = ResultCache(
+    JOB_DB.table('result_cache', indexed=('cached_at',)),
+    resolve=reuse_staging
+)
+
+def with_media(result):
+    """A result with local renditions for each of its output URLs"""
+    return {**result, 'media': MEDIA.media_for(extract_output_urls(result))}
+
+def wait_for_job(job_id, timeout):
+    """Block until the job finishes or timeout seconds pass; returns its state"""
+    deadline = time.monotonic() + timeout
+    while True:
+        with NOTIFIER.listen(job_id) as changed:
+            state = lookup_job(job_id)
+            remaining = deadline - time.monotonic()
+            if state['found'] or state.get('status') == 'failed' or remaining <= 0:
+                return state
+            # Re-read the shared store in case another worker got the webhook
+            changed.wait(min(remaining, EVENTS_RECHECK))
 
 @app.route('/check-result/<job_id>')
 def check_result(job_id):
-    """Check if we have received results for a job"""
-    if job_id in STAGING_RESULTS:
-        return jsonify({
-            'found': True,
-            'result': STAGING_RESULTS[job_id]['data']
-        })
-    return jsonify({'found': False})
+    """Check if we have received results for a job.
+    
+    With ?wait=<seconds> this long-polls: it answers as soon as the job
+    finishes, or with the current state once the wait runs out.
+    """
+    wait = request.args.get('wait', 0, type=float)
+    if not math.isfinite(wait):
+        # nan passes min() and max() unchanged and would never time out
+        return jsonify({'success': False, 'error': 'wait must be a number of seconds'}), 400
+    wait = min(max(wait, 0), MAX_LONG_POLL)
+    if wait:
+        with NOTIFIER.waiter() as admitted:
+            # Past the waiter cap, answer with the current state right away
+            if admitted:
+                return jsonify(wait_for_job(job_id, wait))
+    return jsonify(lookup_job(job_id))
+
+@app.route('/events/<job_id>')
+def job_events(job_id):
+    """Server-sent events stream of a job's state until it finishes.
+    
+    Past the waiter cap this answers 503, and the page falls back to polling.
+    """
+    if not NOTIFIER.start_waiting():
+        response = jsonify({'success': False, 'error': 'Too many open event streams'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    
+    def stream():
+        deadline = time.monotonic() + EVENTS_TIMEOUT
+        last_sent = None
+        idle = 0.0
+        while True:
+            with NOTIFIER.listen(job_id) as changed:
+                state = lookup_job(job_id)
+                if state != last_sent:
+                    yield f"data: {json.dumps(state)}\n\n"
+                    last_sent = state
+                    idle = 0.0
+                if state['found'] or state.get('status') == 'failed':
+                    return
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                # Webhooks handled by another worker can't wake us, so the
+                # shared store is re-read at least every EVENTS_RECHECK seconds
+                wait = min(remaining, EVENTS_RECHECK)
+                if not changed.wait(wait):
+                    idle += wait
+                    if idle >= EVENTS_KEEPALIVE:
+                        yield ': keepalive\n\n'
+                        idle = 0.0
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Runs when the stream ends or the client goes away, even if unstarted
+    response.call_on_close(NOTIFIER.stop_waiting)
+    return response
+
+def get_masks(job_id, image_id, image_url):
+    """Return the masks for an image, creating them only on a cache miss"""
+    masks = MASK_CACHE.get(image_id)
+    if masks:
+        JOBS.update(job_id, mask_cache='hit')
+        return masks
+    
+    # Jobs for the same image that overlap (batches, repeat clicks) share a
+    # single create_mask run
+    JOBS.update(job_id, status='masking')
+    masks, shared = MASK_FLIGHTS.do(image_id, lambda: create_masks(job_id, image_id, image_url))
+    JOBS.update(job_id, mask_cache='shared' if shared else 'miss')
+    return masks
+
+def create_masks(job_id, image_id, image_url):
+    """Run create_mask for an image and wait for the masks"""
+    # Step 1: Create masks
+    try:
+        with METRICS.span('create_mask', job_id):
+            mask_job_id = REIMAGINE.create_mask(image_url)
+    except ReimagineUnavailable:
+        raise StagingError(UNAVAILABLE_MESSAGE)
+    except ReimagineError as e:
+        print(f"[ERROR] create_mask failed for job {job_id}: {e}")
+        raise StagingError('Failed to process image. Please try again.')
+    
+    # Step 2: Wait for masks
+    def check_masks():
+        try:
+            with METRICS.span('mask_status', job_id):
+                status_data = REIMAGINE.get_mask_status(mask_job_id)
+        except ReimagineUnavailable:
+            # No point polling out the deadline against an open breaker
+            raise
+        except ReimagineError:
+            return None
+        if status_data.get('job_status') == 'done':
+            return status_data.get('masks') or []
+        return None
+    
+    try:
+        masks, poll_info = MASK_POLLER.poll(check_masks)
+    except PollTimeout as e:
+        JOBS.update(job_id, mask_polls=e.polls, mask_wait=round(e.elapsed, 2))
+        METRICS.record('mask_wait', e.elapsed, job_id, outcome='timeout')
+        raise StagingError('Processing timeout')
+    except ReimagineUnavailable:
+        raise StagingError(UNAVAILABLE_MESSAGE)
+    
+    JOBS.update(job_id, mask_polls=poll_info['polls'], mask_wait=round(poll_info['elapsed'], 2))
+    METRICS.record('mask_wait', poll_info['elapsed'], job_id)
+    if not masks:
+        raise StagingError('Failed to process room layout')
+    
+    MASK_CACHE.set(image_id, masks)
+    return masks
+
+def unavailable_response():
+    """A 503 to send right away while ReimagineHome's breakers are open, else None"""
+    retry_after = max(REIMAGINE.breakers[name].retry_after() for name in ('create_mask', 'generate_image'))
+    if not retry_after:
+        return None
+    response = jsonify({'success': False, 'error': UNAVAILABLE_MESSAGE})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+def client_key():
+    """Rate-limit key: the caller's API key if it is one of STAGE_API_KEYS, else its address"""
+    supplied = request.headers.get('X-API-Key', '').encode()
+    for api_key in STAGE_API_KEYS:
+        if hmac.compare_digest(supplied, api_key.encode()):
+            return 'key:' + hashlib.sha256(supplied).hexdigest()[:16]
+    return request.remote_addr or 'unknown'
+
+def rate_limited_response(error):
+    response = jsonify({'success': False, 'error': str(error)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(error.retry_after) + 1)
+    return response
+
+def admitted(fn, slots=1):
+    """Wrap a job function so its admission slots are released when it ends"""
+    def run(job_id, *args, **kwargs):
+        try:
+            fn(job_id, *args, **kwargs)
+        finally:
+            ADMISSION.release(slots)
+    return run
+
+def choose_mask_urls(masks):
+    """Furnishing masks, or the largest mask when there are none"""
+    furnishing_masks = [m['url'] for m in masks if 'furnishing' in m.get('category', '')]
+    if furnishing_masks:
+        return furnishing_masks
+    masks_sorted = sorted(masks, key=lambda x: x.get('area_percent', 0), reverse=True)
+    return [masks_sorted[0]['url']] if masks_sorted else []
+
+def start_generation(job_id, image_url, mask_urls, space_type, design_theme, webhook_url):
+    """Submit generate_image and return ReimagineHome's job id"""
+    generation_payload = {
+        'image_url': image_url,
+        'mask_urls': mask_urls,
+        'mask_category': 'furnishing',
+        'space_type': space_type,
+        'generation_count': 1,
+        'webhook_url': webhook_url
+    }
+    
+    if design_theme:
+        generation_payload['design_theme'] = design_theme
+    
+    try:
+        with METRICS.span('generate_image', job_id):
+            return REIMAGINE.generate_image(generation_payload)
+    except ReimagineUnavailable:
+        raise StagingError(UNAVAILABLE_MESSAGE)
+    except ReimagineError as e:
+        print(f"[ERROR] generate_image failed for job {job_id}: {e}")
+        raise StagingError('Failed to start staging')
+
+def run_staging(job_id, image_id, image_url, webhook_base, space_type, design_theme):
+    """Drive one staging job through mask creation and image generation"""
+    masks = get_masks(job_id, image_id, image_url)
+    
+    # Step 3: Generate staged image
+    JOBS.update(job_id, status='generating')
+    reimagine_job_id = start_generation(
+        job_id, image_url, choose_mask_urls(masks), space_type, design_theme,
+        f'{webhook_base}/{job_id}'
+    )
+    
+    # Results arrive later through the webhook, keyed by ReimagineHome's job id
+    JOBS.update(job_id, status='submitted', reimagine_job_id=reimagine_job_id,
+                submitted_at=datetime.now().isoformat(), next_check_at=next_check_at())
+
+def run_variants(job_id, image_id, image_url, webhook_base, space_type, design_themes):
+    """Stage one image in several styles: masks once, then one generation per theme"""
+    masks = get_masks(job_id, image_id, image_url)
+    mask_urls = choose_mask_urls(masks)
+    
+    JOBS.update(job_id, status='generating')
+    webhook_url = f'{webhook_base}/{job_id}'
+    
+    def generate(design_theme):
+        variant = {'design_theme': design_theme}
+        try:
+            variant['reimagine_job_id'] = start_generation(
+                job_id, image_url, mask_urls, space_type, design_theme, webhook_url
+            )
+        except StagingError as e:
+            variant['error'] = str(e)
+        return variant
+    
+    with ThreadPoolExecutor(max_workers=min(len(design_themes), MAX_PARALLEL_VARIANTS)) as pool:
+        variants = list(pool.map(generate, design_themes))
+    
+    if all('error' in variant for variant in variants):
+        JOBS.update(job_id, variants=variants)
+        raise StagingError('Failed to start staging')
+    JOBS.update(job_id, status='submitted', variants=variants,
+                submitted_at=datetime.now().isoformat(), next_check_at=next_check_at())
+
+def lookup_variants(job):
+    """Client-facing state of a multi-variant job"""
+    variants = []
+    pending = job['status'] not in ('submitted', 'completed')
+    for variant in job.get('variants', []):
+        state = {'design_theme': variant['design_theme']}
+        result = final_result(variant.get('reimagine_job_id'))
+        if result:
+            output_urls = extract_output_urls(result['data'])
+            state.update(status='completed', output_urls=output_urls, media=MEDIA.media_for(output_urls))
+        elif 'error' in variant:
+            state.update(status='failed', error=variant['error'])
+        else:
+            state['status'] = 'processing'
+            pending = True
+        variants.append(state)
+    
+    if pending:
+        return {'found': False, 'status': job['status'], 'variants': variants}
+    output_urls = [url for variant in variants for url in variant.get('output_urls', [])]
+    media = [entry for variant in variants for entry in variant.get('media', [])]
+    return {
+        'found': True,
+        'status': 'completed',
+        'result': {'output_urls': output_urls, 'media': media, 'variants': variants}
+    }
+
+def design_themes_error(design_themes):
+    """Why a design_themes value cannot be staged, or None if it can"""
+    if not isinstance(design_themes, list) or not design_themes:
+        return 'design_themes must be a non-empty list'
+    if not all(isinstance(theme, str) for theme in design_themes):
+        return 'design_themes must be a list of strings'
+    if len(design_themes) > MAX_VARIANTS:
+        return f'design_themes is limited to {MAX_VARIANTS} themes'
+    return None
 
 @app.route('/api/stage', methods=['POST'])
 def stage():
+    """Start a staging job.
+    
+    Pass design_themes (a list of up to MAX_VARIANTS) instead of design_theme
+    to get one variant per theme from a single mask run, collected under one
+    job; each variant takes its own admission slot. A repeat of an earlier
+    single-theme staging returns that job unless force is set.
+    """
     data = request.json
     image_id = data.get('image_id')
     space_type = data.get('space_type')
     design_theme = data.get('design_theme')
+    design_themes = data.get('design_themes')
+    force = bool(data.get('force'))
     
     if not all([image_id, space_type]):
         return jsonify({'success': False, 'error': 'Missing required fields'})
+    if design_themes is not None and design_themes_error(design_themes):
+        return jsonify({'success': False, 'error': design_themes_error(design_themes)})
+    
+    if image_id not in IMAGE_STORE:
+        return jsonify({'success': False, 'error': 'Image not found. Please upload it again.'})
+    
+    if not design_themes:
+        if force:
+            RESULT_CACHE.skipped()
+        else:
+            cached = RESULT_CACHE.get(image_id, space_type, design_theme)
+            if cached:
+                return jsonify(cached)
+    
+    unavailable = unavailable_response()
+    if unavailable:
+        return unavailable
+    
+    # One in-flight slot per generation, so variants count like separate stagings
+    slots = len(design_themes) if design_themes else 1
+    try:
+        ADMISSION.check_rate(client_key())
+        ADMISSION.acquire(slots)
+    except RateLimited as e:
+        return rate_limited_response(e)
     
     # Get the app's base URL (will be Render URL in production)
     base_url = request.url_root.rstrip('/')
     image_url = f"{base_url}/image/{image_id}"
-    webhook_url = f"{base_url}/webhook/reimaginehome"
+    webhook_base = f"{base_url}/webhook/reimaginehome"
+    
+    fields = {'image_id': image_id, 'space_type': space_type}
+    if design_themes:
+        fields['design_themes'] = design_themes
+        job_id = JOBS.submit(admitted(run_variants, slots), image_id, image_url, webhook_base, space_type,
+                             design_themes, fields=fields)
+    else:
+        fields['design_theme'] = design_theme
+        job_id = JOBS.submit(admitted(run_staging), image_id, image_url, webhook_base, space_type,
+                             design_theme, fields=fields)
+        RESULT_CACHE.put(image_id, space_type, design_theme, job_id=job_id)
+    
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'message': 'Staging in progress'
+    })
+
+@app.route('/api/stage/batch', methods=['POST'])
+def stage_batch():
+    """Stage many photos in many styles with one request.
+    
+    Body: {"images": [{"image_id": ..., "space_type": ...}, ...],
+           "design_themes": [...], "space_type": <default>}
+    Each image becomes one multi-variant job, so its masks are created once
+    and reused by all of its themes. The jobs run on the batch pool, so
+    single stagings do not wait behind them.
+    """
+    data = request.json or {}
+    images = data.get('images') or []
+    design_themes = data.get('design_themes') or ['']
+    
+    if not images:
+        return jsonify({'success': False, 'error': 'No images provided'})
+    if design_themes_error(design_themes):
+        return jsonify({'success': False, 'error': design_themes_error(design_themes)})
+    if len(images) * len(design_themes) > MAX_BATCH_JOBS:
+        return jsonify({'success': False, 'error': f'Batches are limited to {MAX_BATCH_JOBS} stagings'})
     
-    headers = {'api-key': REIMAGINEHOME_API_KEY}
+    for image in images:
+        if not isinstance(image, dict):
+            return jsonify({'success': False, 'error': 'Missing required fields'})
+        image.setdefault('space_type', data.get('space_type'))
+        if not image.get('image_id') or not image.get('space_type'):
+            return jsonify({'success': False, 'error': 'Missing required fields'})
+        if image['image_id'] not in IMAGE_STORE:
+            return jsonify({'success': False, 'error': f"Image {image['image_id']} not found. Please upload it again."})
     
+    unavailable = unavailable_response()
+    if unavailable:
+        return unavailable
+    
+    # One rate-limit token per image, one in-flight slot per generation
     try:
-        # Step 1: Create masks
-        mask_response = requests.post(
-            'https://api.reimaginehome.ai/v1/create_mask',
-            headers=headers,
-            json={'image_url': image_url}
-        )
-        
-        if mask_response.status_code != 200:
-            return jsonify({
-                'success': False,
-                'error': 'Failed to process image. Please try again.'
-            })
-        
-        mask_job_id = mask_response.json()['data']['job_id']
-        
-        # Step 2: Wait for masks
-        masks = None
-        for i in range(20):
-            time.sleep(2)
-            status_response = requests.get(
-                f'https://api.reimaginehome.ai/v1/create_mask/{mask_job_id}',
-                headers=headers
-            )
-            
-            if status_response.status_code == 200:
-                status_data = status_response.json()
-                if status_data.get('data', {}).get('job_status') == 'done':
-                    masks = status_data['data']['masks']
-                    break
-        
-        if not masks:
-            return jsonify({'success': False, 'error': 'Processing timeout'})
-        
-        # Step 3: Generate staged image
-        furnishing_masks = [m['url'] for m in masks if 'furnishing' in m.get('category', '')]
-        if not furnishing_masks:
-            masks_sorted = sorted(masks, key=lambda x: x.get('area_percent', 0), reverse=True)
-            mask_urls = [masks_sorted[0]['url']] if masks_sorted else []
-        else:
-            mask_urls = furnishing_masks
-        
-        generation_payload = {
-            'image_url': image_url,
-            'mask_urls': mask_urls,
-            'mask_category': 'furnishing',
-            'space_type': space_type,
-            'generation_count': 1,
-            'webhook_url': webhook_url
+        ADMISSION.check_rate(client_key(), cost=len(images))
+        ADMISSION.acquire(len(images) * len(design_themes))
+    except RateLimited as e:
+        return rate_limited_response(e)
+    
+    base_url = request.url_root.rstrip('/')
+    webhook_base = f"{base_url}/webhook/reimaginehome"
+    
+    jobs = []
+    for image in images:
+        image_url = f"{base_url}/image/{image['image_id']}"
+        fields = {
+            'image_id': image['image_id'],
+            'space_type': image['space_type'],
+            'design_themes': design_themes
         }
-        
-        if design_theme:
-            generation_payload['design_theme'] = design_theme
-            
-        gen_response = requests.post(
-            'https://api.reimaginehome.ai/v1/generate_image',
-            headers=headers,
-            json=generation_payload
-        )
-        
-        if gen_response.status_code == 200:
-            result = gen_response.json()
-            job_id = result.get('data', {}).get('job_id', 'processing')
-            
-            return jsonify({
-                'success': True,
-                'job_id': job_id,
-                'message': 'Staging in progress'
-            })
+        job_id = JOBS.submit(admitted(run_variants, len(design_themes)), image['image_id'], image_url,
+                             webhook_base, image['space_type'], design_themes, fields=fields, pool='batch')
+        jobs.append({'job_id': job_id, **fields})
+    
+    batch_id = uuid.uuid4().hex[:12]
+    STAGING_BATCHES[batch_id] = {
+        'batch_id': batch_id,
+        'created_at': datetime.now().isoformat(),
+        'jobs': jobs
+    }
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'jobs': jobs,
+        'message': f'{len(jobs) * len(design_themes)} stagings in progress'
+    })
+
+@app.route('/api/stage/batch/<batch_id>')
+def check_batch(batch_id):
+    """Aggregated progress and results for a batch"""
+    batch = STAGING_BATCHES.get(batch_id)
+    if batch is None:
+        return jsonify({'success': False, 'error': 'Batch not found'}), 404
+    
+    counts = {'completed': 0, 'failed': 0, 'processing': 0}
+    jobs = []
+    for job in batch['jobs']:
+        state = lookup_job(job['job_id'])
+        if state['found']:
+            counts['completed'] += 1
+        elif state.get('status') == 'failed':
+            counts['failed'] += 1
         else:
-            return jsonify({
-                'success': False,
-                'error': 'Failed to start staging'
-            })
-            
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+            counts['processing'] += 1
+        jobs.append({**job, **state})
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'total': len(jobs),
+        **counts,
+        'done': counts['processing'] == 0,
+        'jobs': jobs
+    })
+
+@app.route('/media/<digest>/<rendition>')
+def serve_media(digest, rendition):
+    """Serve a mirrored output or one of its renditions"""
+    image, key = MEDIA.get(digest, os.path.splitext(rendition)[0])
+    if image is None:
+        return 'Image not found', 404
+    # URLs name the content, so it can be cached for good
+    return send_image(image, key, max_age=365 * 24 * 3600, immutable=True)
+
+@app.route('/api/stats')
+def stats():
+    """Cache and storage counters"""
+    return jsonify({
+        'image_store': IMAGE_STORE.stats(),
+        'uploads': FINGERPRINTS.stats(),
+        'mask_cache': MASK_CACHE.stats(),
+        'result_cache': RESULT_CACHE.stats(),
+        'mask_latency': MASK_POLLER.stats.summary(),
+        'reimagine': REIMAGINE.stats(),
+        'admission': ADMISSION.stats(),
+        'webhooks': {**WEBHOOKS.stats(), 'outcomes': WEBHOOK_DEDUPE.stats()},
+        'reconciler': RECONCILER.stats(),
+        'waiters': NOTIFIER.stats(),
+        'media': MEDIA.stats()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Stage latency histograms and counters in Prometheus text format"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/limits', methods=['GET', 'POST'])
+def admin_limits():
+    """Read or change the staging rate limits at runtime.
+    
+    Requires ADMIN_TOKEN as a bearer token; the route does not exist
+    when ADMIN_TOKEN is unset. POST a JSON object with any of
+    rate_per_minute, burst, max_active, max_waiting and wait_timeout.
+    """
+    if not ADMIN_TOKEN:
+        return 'Not found', 404
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    if request.method == 'POST':
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict):
+            return jsonify({'success': False, 'error': 'Expected a JSON object of limits'}), 400
+        try:
+            ADMISSION.configure(**changes)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({'success': True, **ADMISSION.stats()})
 
 # For local development
 if __name__ == '__main__':
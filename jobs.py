@@ -0,0 +1,121 @@
+"""Background job engine for the staging pipeline.
+
+Requests enqueue a job and return its id right away; a bounded thread pool
+drives each job through its steps and records progress on the job record.
+
+Jobs can be sent to named pools, each with its own threads, so a large
+batch queued in one pool cannot hold up single jobs waiting in another.
+
+The queue and running pipelines live in the worker process, so a restart
+loses them while their records stay behind. With a lease, every job carries
+a next_check_at that its process keeps pushing forward until the job's
+function returns; a job whose lease runs out was orphaned.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+class StagingError(Exception):
+    """A pipeline failure with a message that is safe to show the user"""
+
+
+class JobEngine:
+    def __init__(self, max_workers=4, records=None, on_update=None, lease=None, pools=None):
+        self.max_workers = max_workers
+        # Threads per named pool; jobs go to 'default' unless submitted to another
+        self.pools = {'default': max_workers, **(pools or {})}
+        # Any dict-like store; a shared one lets other workers read job status
+        self.jobs = records if records is not None else {}
+        # Called with the job id after every status change
+        self.on_update = on_update
+        # Seconds a job's next_check_at is held ahead of now while it runs
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._executors = {}
+        self._pid = None
+        self._active = set()
+
+    def _get_executor(self, pool='default'):
+        # Created lazily (and re-created after a fork) so every gunicorn
+        # worker gets its own live threads.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executors = {}
+                self._pid = os.getpid()
+                self._active = set()
+                if self.lease:
+                    threading.Thread(target=self._renew_leases, name='staging-leases', daemon=True).start()
+            if pool not in self._executors:
+                self._executors[pool] = ThreadPoolExecutor(
+                    max_workers=self.pools[pool],
+                    thread_name_prefix='staging' if pool == 'default' else f'staging-{pool}'
+                )
+            return self._executors[pool]
+
+    def _lease_expiry(self):
+        return (datetime.now() + timedelta(seconds=self.lease)).isoformat()
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease / 4)
+            with self._lock:
+                for job_id in self._active:
+                    job = self.jobs.get(job_id)
+                    if job is not None:
+                        job['next_check_at'] = self._lease_expiry()
+                        self.jobs[job_id] = job
+
+    def submit(self, fn, *args, fields=None, pool='default', **kwargs):
+        """Queue fn(job_id, *args, **kwargs) on a pool and return the new job id.
+
+        fields are extra values stored on the job record from the start.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        now = datetime.now().isoformat()
+        executor = self._get_executor(pool)
+        with self._lock:
+            self.jobs[job_id] = {
+                **(fields or {}),
+                'job_id': job_id,
+                'status': 'queued',
+                'created_at': now,
+                'updated_at': now,
+                'error': None,
+                **({'next_check_at': self._lease_expiry()} if self.lease else {})
+            }
+            self._active.add(job_id)
+        executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        try:
+            fn(job_id, *args, **kwargs)
+        except StagingError as e:
+            self.update(job_id, status='failed', error=str(e))
+        except Exception as e:
+            print(f"[ERROR] Staging job {job_id} crashed: {e}")
+            self.update(job_id, status='failed', error=str(e))
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields)
+            job['updated_at'] = datetime.now().isoformat()
+            self.jobs[job_id] = job
+        if self.on_update:
+            self.on_update(job_id)
+
+    def get(self, job_id):
+        """Return a snapshot of the job record, or None if unknown"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
@@ -0,0 +1,181 @@
+"""Local mirror of staged results.
+
+ReimagineHome's output images are several MB each. When a result comes in,
+each output is fetched once in the background and stored here by the
+SHA-256 of its bytes, next to a thumbnail and a web-sized rendition. Pages
+then load the renditions from /media/<digest>/<rendition>; the content
+never changes under a URL, so they are served with year-long immutable
+cache headers.
+"""
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+from imaging import ImageError, normalize_image
+from webhooks import log_event
+
+# Longest edge in pixels for each rendition
+RENDITIONS = {
+    'thumb': int(os.getenv('MEDIA_THUMB_EDGE', 320)),
+    'web': int(os.getenv('MEDIA_WEB_EDGE', 1280))
+}
+MEDIA_QUALITY = int(os.getenv('MEDIA_QUALITY', 80))
+MEDIA_FETCH_TIMEOUT = (5, 30)
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_MB', 40)) * 1024 * 1024
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Only outputs on these hosts (or their subdomains) are fetched, so a forged
+# webhook cannot point the server at internal addresses or arbitrary files
+MEDIA_ALLOWED_HOSTS = tuple(
+    host.strip().lower() for host in os.getenv('MEDIA_ALLOWED_HOSTS', 'reimaginehome.ai').split(',') if host.strip()
+)
+
+ORIGINAL_MIMETYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+class MediaMirror:
+    """Fetch remote outputs once and keep them, with renditions, in an image store.
+
+    store holds the image bytes; index (a dict-like shared by every worker)
+    maps each remote URL to the digest and renditions made from it.
+    """
+
+    def __init__(self, store, index, workers=2, renditions=RENDITIONS, route='/media',
+                 allowed_hosts=MEDIA_ALLOWED_HOSTS):
+        self.store = store
+        self.index = index
+        self.allowed_hosts = tuple(allowed_hosts)
+        self.workers = workers
+        self.renditions = dict(renditions)
+        self.route = route
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._pending = set()
+        self.mirrored = 0
+        self.failed = 0
+
+    def _get_executor(self):
+        # Created lazily (and re-created after a fork) like the job engine's
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='media')
+                self._pid = os.getpid()
+                self._pending = set()
+            return self._executor
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def store_key(self, digest, rendition):
+        return digest if rendition == 'original' else f'{digest}-{rendition}'
+
+    def allowed(self, url):
+        """Whether url is an http(s) URL on one of the allowed hosts"""
+        if not isinstance(url, str):
+            return False
+        try:
+            parts = urlsplit(url)
+            host = (parts.hostname or '').rstrip('.')
+        except ValueError:
+            return False
+        return parts.scheme in ('http', 'https') and any(
+            host == allowed or host.endswith('.' + allowed) for allowed in self.allowed_hosts
+        )
+
+    def mirror(self, urls):
+        """Queue background mirroring of any allowed URLs not mirrored yet"""
+        executor = self._get_executor()
+        for url in urls:
+            if not self.allowed(url):
+                log_event('media_mirror_skipped', url=url if isinstance(url, str) else None)
+                continue
+            if self.lookup(url) is not None:
+                continue
+            with self._lock:
+                if url in self._pending:
+                    continue
+                self._pending.add(url)
+            executor.submit(self._mirror_one, url)
+
+    def _mirror_one(self, url):
+        try:
+            record = self._fetch_and_render(url)
+            self.index[self._key(url)] = record
+            with self._lock:
+                self.mirrored += 1
+        except (requests.RequestException, ImageError, ValueError) as e:
+            with self._lock:
+                self.failed += 1
+            log_event('media_mirror_failed', url=url, error=str(e))
+        finally:
+            with self._lock:
+                self._pending.discard(url)
+
+    def _fetch_and_render(self, url):
+        # Redirects are not followed; they could lead off the allowed hosts
+        with self.session.get(url, stream=True, timeout=MEDIA_FETCH_TIMEOUT, allow_redirects=False) as response:
+            response.raise_for_status()
+            if response.is_redirect:
+                raise ValueError(f'Output redirected to {response.headers.get("Location")}')
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(MEDIA_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    raise ValueError(f'Output larger than {MEDIA_MAX_BYTES} bytes')
+                chunks.append(chunk)
+        data = b''.join(chunks)
+        digest = hashlib.sha256(data).hexdigest()[:32]
+
+        record = {'url': url, 'digest': digest, 'bytes': len(data), 'renditions': {}}
+        for name, edge in self.renditions.items():
+            rendition, mimetype, info = normalize_image(data, max_edge=edge, quality=MEDIA_QUALITY)
+            self.store.put(self.store_key(digest, name), rendition, mimetype)
+            record['renditions'][name] = {'size': info['size'], 'bytes': info['bytes']}
+
+        # Keep the original too when it is a format the store can serve
+        mimetype = ORIGINAL_MIMETYPES.get(info['original_format'])
+        if mimetype:
+            self.store.put(digest, data, mimetype)
+            record['renditions']['original'] = {'size': info['original_size'], 'bytes': len(data)}
+        return record
+
+    def lookup(self, url):
+        """Local URLs for a mirrored output, or None if not (or no longer) mirrored"""
+        record = self.index.get(self._key(url)) if isinstance(url, str) else None
+        if record is None:
+            return None
+        digest = record['digest']
+        # The store may have evicted the files; report it unmirrored so it is fetched again
+        if self.store_key(digest, 'web') not in self.store:
+            return None
+        return {
+            name: f'{self.route}/{digest}/{name}'
+            for name in record['renditions']
+        }
+
+    def media_for(self, urls):
+        """One entry per output URL with whichever local renditions exist"""
+        return [{'url': url, **(self.lookup(url) or {})} for url in urls]
+
+    def get(self, digest, rendition):
+        """(StoredImage, store key) for a /media request, or (None, None)"""
+        if rendition != 'original' and rendition not in self.renditions:
+            return None, None
+        key = self.store_key(digest, rendition)
+        return self.store.get(key), key
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'mirrored': self.mirrored,
+                'failed': self.failed,
+                'store': self.store.stats()
+            }
@@ -0,0 +1,97 @@
+"""Adaptive polling for ReimagineHome mask jobs.
+
+The first status check is scheduled from the mask latencies seen so far,
+later checks back off exponentially with jitter, and the whole wait is
+bounded by a deadline.
+"""
+import random
+import threading
+import time
+from collections import deque
+
+
+class PollTimeout(Exception):
+    """Raised when the deadline passes before the job is ready"""
+
+    def __init__(self, polls, elapsed):
+        super().__init__(f'Not ready after {polls} polls in {elapsed:.1f}s')
+        self.polls = polls
+        self.elapsed = elapsed
+
+
+class LatencyStats:
+    """Rolling window of observed job latencies (seconds)"""
+
+    def __init__(self, window=100):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def summary(self):
+        with self._lock:
+            count = len(self._samples)
+        return {
+            'count': count,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9)
+        }
+
+
+class BackoffPoller:
+    def __init__(self, initial_delay=0.5, max_delay=8.0, multiplier=2.0, jitter=0.2,
+                 deadline=40.0, stats=None, sleep=time.sleep, clock=time.monotonic):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.stats = stats or LatencyStats()
+        self._sleep = sleep
+        self._clock = clock
+
+    def first_delay(self):
+        """Wait before the first check: just under the fast end of observed latency"""
+        observed = self.stats.quantile(0.25)
+        if observed is None:
+            return self.initial_delay
+        return min(max(self.initial_delay, observed * 0.9), self.max_delay)
+
+    def _jittered(self, delay):
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def poll(self, check):
+        """Call check() until it returns something other than None.
+
+        Returns (result, info) where info has the number of polls and the
+        elapsed seconds; raises PollTimeout once the deadline has passed.
+        """
+        start = self._clock()
+        delay = self.first_delay()
+        next_delay = self.initial_delay
+        polls = 0
+
+        while True:
+            remaining = self.deadline - (self._clock() - start)
+            if remaining <= 0:
+                raise PollTimeout(polls, self._clock() - start)
+
+            self._sleep(min(self._jittered(delay), remaining))
+            polls += 1
+            result = check()
+            if result is not None:
+                elapsed = self._clock() - start
+                self.stats.record(elapsed)
+                return result, {'polls': polls, 'elapsed': elapsed}
+
+            delay = next_delay
+            next_delay = min(next_delay * self.multiplier, self.max_delay)
@@ -0,0 +1,353 @@
+"""Admission control for the staging endpoints.
+
+Each client (API key, else remote address) gets a token bucket, and a
+global cap bounds how much staging work runs at once. Requests over the
+cap wait in a bounded queue for a short while; anything beyond that is
+turned away with a retry hint instead of piling onto workers and the
+upstream quota.
+
+Given shared tables (the job database), buckets and the slot count are
+kept there, so the limits hold across every gunicorn worker rather than
+per process; without them they are in-process, for tests and scripts. The
+limits themselves live in a shared store and are re-read every few
+seconds, so changing them at runtime reaches every worker.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from cache import TTLCache
+
+LIMIT_KEYS = ('rate_per_minute', 'burst', 'max_active', 'max_waiting', 'wait_timeout')
+
+
+class RateLimited(Exception):
+    """Raised when a request is not admitted; retry_after is in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Per-client token buckets, in-process or in a shared table.
+
+    A request may cost more than the burst (a batch charged per image); it
+    is admitted only with a full bucket and leaves the bucket in debt, so
+    the client then waits as long as the batch's cost takes to refill.
+    """
+
+    def __init__(self, rate_per_minute=30, burst=10, max_clients=10000, clock=time.time, store=None):
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_clients = max_clients
+        self.store = store
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Idle clients' buckets expire once they would have refilled anyway
+        self._buckets = TTLCache(maxsize=max_clients, ttl=3600)
+        self._checks = 0
+        self.limited = 0
+
+    def _take(self, bucket, cost):
+        """(new bucket, tokens short or None if admitted)"""
+        rate = self.rate_per_minute / 60.0
+        now = self._clock()
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket['tokens'] + max(0.0, now - bucket['updated_at']) * rate)
+        needed = min(cost, self.burst)
+        if tokens >= needed:
+            return {'tokens': tokens - cost, 'updated_at': now}, None
+        return {'tokens': tokens, 'updated_at': now}, needed - tokens
+
+    def check(self, key, cost=1):
+        """Take cost tokens from key's bucket or raise RateLimited"""
+        if self.store is not None:
+            short = self.store.transact(key, lambda bucket: self._take(bucket, cost))
+            self._trim()
+        else:
+            with self._lock:
+                bucket, short = self._take(self._buckets.get(key), cost)
+                self._buckets.set(key, bucket)
+        if short is None:
+            return
+        with self._lock:
+            self.limited += 1
+        rate = self.rate_per_minute / 60.0
+        retry_after = short / rate if rate > 0 else 60.0
+        raise RateLimited('Too many staging requests. Please slow down.', retry_after)
+
+    def _trim(self):
+        # Shared buckets are pruned to the most recently used now and then
+        with self._lock:
+            self._checks += 1
+            if self._checks % 1000:
+                return
+        self.store.trim('updated_at', self.max_clients)
+
+    def stats(self):
+        with self._lock:
+            return {'limited': self.limited}
+
+
+class ConcurrencyLimiter:
+    """A cap on in-flight work with a short, bounded wait queue.
+
+    With a shared store, every process keeps its active and waiting counts
+    in one record and waiters poll it. A process that stops heartbeating
+    (a killed worker, an old deploy) is dropped after stale seconds, so its
+    slots are not lost for good.
+    """
+
+    def __init__(self, max_active=8, max_waiting=16, wait_timeout=10.0, store=None,
+                 key='concurrency', poll=0.1, stale=60.0):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.store = store
+        self.key = key
+        self.poll = poll
+        self.stale = stale
+        self._cond = threading.Condition()
+        self._pid = None
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def acquire(self, n=1):
+        """Take n slots, waiting up to wait_timeout in the queue, or raise RateLimited"""
+        with self._cond:
+            if n > self.max_active:
+                self.rejected += 1
+                raise RateLimited(f'Requests are limited to {self.max_active} stagings at once', 60.0)
+        if self.store is not None:
+            return self._acquire_shared(n)
+
+        with self._cond:
+            if self.active + n <= self.max_active and not self.waiting:
+                self.active += n
+                return
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise RateLimited('The server is busy. Please try again shortly.', self.wait_timeout)
+
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(
+                    lambda: self.active + n <= self.max_active,
+                    timeout=self.wait_timeout
+                )
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                raise RateLimited('The server is busy. Please try again shortly.', self.wait_timeout)
+            self.active += n
+
+    def release(self, n=1):
+        if self.store is not None:
+            self._update(lambda me, active, waiting: me.update(active=max(0, me['active'] - n)))
+        with self._cond:
+            self.active = max(0, self.active - n)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, n=1):
+        self.acquire(n)
+        try:
+            yield
+        finally:
+            self.release(n)
+
+    def _acquire_shared(self, n):
+        deadline = time.monotonic() + self.wait_timeout
+        queued = False
+
+        def admit(me, active, waiting):
+            # Newcomers queue behind existing waiters; waiters take any room
+            if active + n <= self.max_active and (queued or not waiting):
+                me['active'] += n
+                me['waiting'] -= queued
+                return 'admitted'
+            if queued:
+                return 'waiting'
+            if waiting >= self.max_waiting:
+                return 'full'
+            me['waiting'] += 1
+            return 'waiting'
+
+        while True:
+            outcome = self._update(admit)
+            if outcome == 'admitted':
+                with self._cond:
+                    self.active += n
+                    self.waiting -= queued
+                return
+            if outcome == 'full' or time.monotonic() >= deadline:
+                if queued:
+                    self._update(lambda me, active, waiting: me.update(waiting=max(0, me['waiting'] - 1)))
+                    with self._cond:
+                        self.waiting -= 1
+                with self._cond:
+                    self.rejected += 1
+                raise RateLimited('The server is busy. Please try again shortly.', self.wait_timeout)
+            if not queued:
+                queued = True
+                with self._cond:
+                    self.waiting += 1
+            time.sleep(self.poll)
+
+    def _process(self):
+        # One identity per process, heartbeated while the process lives
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._process_id = f'{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}'
+                threading.Thread(target=self._heartbeat, daemon=True).start()
+            return self._process_id
+
+    def _update(self, fn):
+        """Run fn(this process's entry, total active, total waiting) on the shared record"""
+        process_id = self._process()
+
+        def change(record):
+            now = time.time()
+            processes = {
+                key: entry for key, entry in ((record or {}).get('processes') or {}).items()
+                if now - entry['seen_at'] < self.stale
+            }
+            me = processes.setdefault(process_id, {'active': 0, 'waiting': 0})
+            me['seen_at'] = now
+            active = sum(entry['active'] for entry in processes.values())
+            waiting = sum(entry['waiting'] for entry in processes.values())
+            result = fn(me, active, waiting)
+            if not me['active'] and not me['waiting']:
+                del processes[process_id]
+            return {'processes': processes}, result
+
+        return self.store.transact(self.key, change)
+
+    def _heartbeat(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.stale / 4)
+            with self._cond:
+                busy = self.active or self.waiting
+            if not busy:
+                continue
+            try:
+                self._update(lambda me, active, waiting: None)
+            except Exception:
+                # A locked or briefly unavailable database; retried next beat
+                pass
+
+    def stats(self):
+        with self._cond:
+            stats = {'active': self.active, 'waiting': self.waiting, 'rejected': self.rejected}
+        if self.store is not None:
+            # Totals across processes; this process's own counts stay alongside
+            processes = (self.store.get(self.key) or {}).get('processes') or {}
+            now = time.time()
+            live = [entry for entry in processes.values() if now - entry['seen_at'] < self.stale]
+            stats.update(
+                worker_active=stats['active'],
+                worker_waiting=stats['waiting'],
+                active=sum(entry['active'] for entry in live),
+                waiting=sum(entry['waiting'] for entry in live),
+                processes=len(live)
+            )
+        return stats
+
+
+class AdmissionControl:
+    """Token buckets and a concurrency cap driven by shared, editable limits.
+
+    store is any dict-like; the current limits are kept under 'limits'.
+    buckets and slots are shared RecordTables (see job_store) holding the
+    token buckets and the in-flight count; without them both are per
+    process.
+    """
+
+    def __init__(self, defaults, store=None, buckets=None, slots=None, refresh=5.0, clock=time.monotonic):
+        self.defaults = {key: defaults[key] for key in LIMIT_KEYS}
+        self.store = store if store is not None else {}
+        self.refresh = refresh
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self.rate = TokenBucketLimiter(defaults['rate_per_minute'], defaults['burst'], store=buckets)
+        self.concurrency = ConcurrencyLimiter(
+            defaults['max_active'], defaults['max_waiting'], defaults['wait_timeout'], store=slots
+        )
+
+    def limits(self):
+        """Current limits, re-read from the store when stale"""
+        with self._lock:
+            if self._loaded_at is None or self._clock() - self._loaded_at >= self.refresh:
+                self._apply({**self.defaults, **(self.store.get('limits') or {})})
+                self._loaded_at = self._clock()
+            return self._current()
+
+    def configure(self, **changes):
+        """Validate and store new limits; returns the limits now in effect"""
+        unknown = set(changes) - set(LIMIT_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown limits: {', '.join(sorted(unknown))}")
+        for key, value in changes.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f'{key} must be a non-negative number')
+        if changes.get('burst') == 0 or changes.get('max_active') == 0:
+            raise ValueError('burst and max_active must be at least 1')
+
+        with self._lock:
+            limits = {**self._current(), **changes}
+            self.store['limits'] = limits
+            self._apply(limits)
+            self._loaded_at = self._clock()
+            return self._current()
+
+    def _current(self):
+        return {
+            'rate_per_minute': self.rate.rate_per_minute,
+            'burst': self.rate.burst,
+            'max_active': self.concurrency.max_active,
+            'max_waiting': self.concurrency.max_waiting,
+            'wait_timeout': self.concurrency.wait_timeout
+        }
+
+    def _apply(self, limits):
+        self.rate.rate_per_minute = limits['rate_per_minute']
+        self.rate.burst = limits['burst']
+        with self.concurrency._cond:
+            self.concurrency.max_active = int(limits['max_active'])
+            self.concurrency.max_waiting = int(limits['max_waiting'])
+            self.concurrency.wait_timeout = limits['wait_timeout']
+            # A raised cap may admit queued requests right away
+            self.concurrency._cond.notify_all()
+
+    def check_rate(self, key, cost=1):
+        self.limits()
+        self.rate.check(key, cost)
+
+    def acquire(self, n=1):
+        self.limits()
+        self.concurrency.acquire(n)
+
+    def release(self, n=1):
+        self.concurrency.release(n)
+
+    def slot(self, n=1):
+        self.limits()
+        return self.concurrency.slot(n)
+
+    def stats(self):
+        return {
+            'limits': self.limits(),
+            'rate': self.rate.stats(),
+            'concurrency': self.concurrency.stats()
+        }
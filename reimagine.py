@@ -0,0 +1,188 @@
+"""ReimagineHome API client.
+
+All calls share one keep-alive session with a connection pool, so repeated
+requests (mask status polls especially) reuse an open TLS connection
+instead of paying a new handshake each time.
+
+Each endpoint sits behind its own circuit breaker, and transient failures
+are retried with jittered backoff while the shared retry budget allows.
+"""
+import asyncio
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from breaker import CircuitBreaker, CircuitOpenError, RetryBudget, backoff_delay
+
+API_BASE_URL = 'https://api.reimaginehome.ai/v1'
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (
+    float(os.getenv('REIMAGINEHOME_CONNECT_TIMEOUT', 5)),
+    float(os.getenv('REIMAGINEHOME_READ_TIMEOUT', 30))
+)
+MAX_RETRIES = int(os.getenv('REIMAGINEHOME_MAX_RETRIES', 2))
+BREAKER_THRESHOLD = int(os.getenv('REIMAGINEHOME_BREAKER_THRESHOLD', 5))
+BREAKER_RESET = float(os.getenv('REIMAGINEHOME_BREAKER_RESET', 30))
+
+ENDPOINTS = ('create_mask', 'mask_status', 'generate_image', 'generation_status')
+
+# Statuses worth retrying; for POSTs only those that mean the request was
+# not acted on, so a retry cannot start a second job
+RETRY_STATUSES = {'GET': {429, 500, 502, 503, 504}, 'POST': {429, 503}}
+
+
+class ReimagineError(Exception):
+    """Raised when ReimagineHome returns an error or an unusable response"""
+
+    def __init__(self, message, status_code=None, payload=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.payload = payload
+
+    @property
+    def transient(self):
+        """True for failures that say nothing about the request itself"""
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
+
+class ReimagineUnavailable(ReimagineError):
+    """Raised without calling ReimagineHome while an endpoint's breaker is open"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, 503)
+        self.retry_after = retry_after
+
+
+class ReimagineClient:
+    def __init__(self, api_key, base_url=API_BASE_URL, timeout=DEFAULT_TIMEOUT, pool_size=20,
+                 max_retries=MAX_RETRIES, retry_budget=None, sleep=time.sleep):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breakers = {
+            endpoint: CircuitBreaker(endpoint, BREAKER_THRESHOLD, BREAKER_RESET)
+            for endpoint in ENDPOINTS
+        }
+        self._sleep = sleep
+        self.session = requests.Session()
+        self.session.headers['api-key'] = api_key or ''
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _request(self, endpoint, method, path, timeout=None, **kwargs):
+        """Call an endpoint through its breaker, retrying transient failures"""
+        breaker = self.breakers[endpoint]
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                raise ReimagineUnavailable(str(e), e.retry_after) from e
+
+            try:
+                data = self._send(method, path, timeout, **kwargs)
+            except ReimagineError as e:
+                if not e.transient:
+                    # The service answered; the request itself was bad
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                attempt += 1
+                if (attempt > self.max_retries or not self._retryable(method, e)
+                        or not self.retry_budget.withdraw()):
+                    raise
+                self._sleep(backoff_delay(attempt))
+                continue
+
+            breaker.record_success()
+            return data
+
+    @staticmethod
+    def _retryable(method, error):
+        if isinstance(error.__cause__, requests.ConnectTimeout):
+            # The request never reached the server
+            return True
+        if error.status_code is None:
+            return method == 'GET'
+        return error.status_code in RETRY_STATUSES.get(method, ())
+
+    def _send(self, method, path, timeout=None, **kwargs):
+        try:
+            response = self.session.request(
+                method,
+                f'{self.base_url}/{path}',
+                timeout=timeout or self.timeout,
+                **kwargs
+            )
+        except requests.RequestException as e:
+            raise ReimagineError(f'{method} {path} failed: {e}') from e
+
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+
+        if response.status_code != 200:
+            message = (payload or {}).get('error_message') or f'HTTP {response.status_code}'
+            raise ReimagineError(message, response.status_code, payload)
+        if not isinstance(payload, dict):
+            raise ReimagineError('Invalid JSON response', response.status_code)
+        return payload.get('data') or {}
+
+    def create_mask(self, image_url, timeout=None):
+        """Start mask creation and return the mask job id"""
+        data = self._request('create_mask', 'POST', 'create_mask', timeout, json={'image_url': image_url})
+        if 'job_id' not in data:
+            raise ReimagineError('create_mask response has no job_id', payload=data)
+        return data['job_id']
+
+    def get_mask_status(self, mask_job_id, timeout=None):
+        """Return the mask job's data (job_status, masks, ...)"""
+        return self._request('mask_status', 'GET', f'create_mask/{mask_job_id}', timeout)
+
+    def generate_image(self, payload, timeout=None):
+        """Start image generation and return ReimagineHome's job id"""
+        data = self._request('generate_image', 'POST', 'generate_image', timeout, json=payload)
+        return data.get('job_id')
+
+    def get_generation_status(self, job_id, timeout=None):
+        """Return a generation job's data (job_status, output URLs, ...)"""
+        return self._request('generation_status', 'GET', f'generate_image/{job_id}', timeout)
+
+    def stats(self):
+        return {
+            'breakers': {name: breaker.stats() for name, breaker in self.breakers.items()},
+            'retry_budget': self.retry_budget.stats()
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncReimagineClient:
+    """asyncio front end over a ReimagineClient.
+
+    Calls run in the default executor and go through the wrapped client's
+    pooled session, so sync and async callers share the same connections.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def create_mask(self, image_url, timeout=None):
+        return await asyncio.to_thread(self.client.create_mask, image_url, timeout)
+
+    async def get_mask_status(self, mask_job_id, timeout=None):
+        return await asyncio.to_thread(self.client.get_mask_status, mask_job_id, timeout)
+
+    async def generate_image(self, payload, timeout=None):
+        return await asyncio.to_thread(self.client.generate_image, payload, timeout)
+
+    async def get_generation_status(self, job_id, timeout=None):
+        return await asyncio.to_thread(self.client.get_generation_status, job_id, timeout)
@@ -0,0 +1,63 @@
+"""Keep the AiStager app's copies of the shared modules in step.
+
+Both apps deploy from their own directory, so the modules they share are
+copied into Claude Code Projects/AiStager. The files in this directory are
+the source of truth: edit them here, then run
+
+    python sync_shared.py           # copy them over
+    python sync_shared.py --check   # exit 1 if any copy differs
+
+The check also runs in the test suite.
+"""
+import filecmp
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+AISTAGER = os.path.join(ROOT, 'Claude Code Projects', 'AiStager')
+
+SHARED_MODULES = (
+    'breaker.py',
+    'cache.py',
+    'fingerprint.py',
+    'image_store.py',
+    'imaging.py',
+    'job_store.py',
+    'media.py',
+    'notify.py',
+    'polling.py',
+    'ratelimit.py',
+    'reconcile.py',
+    'reimagine.py',
+    'result_cache.py',
+    'tracing.py',
+    'webhooks.py'
+)
+
+
+def drifted():
+    """Shared modules whose AiStager copy is missing or differs from the source"""
+    return [
+        name for name in SHARED_MODULES
+        if not os.path.exists(os.path.join(AISTAGER, name))
+        or not filecmp.cmp(os.path.join(ROOT, name), os.path.join(AISTAGER, name), shallow=False)
+    ]
+
+
+def sync():
+    """Copy every drifted module over; returns their names"""
+    names = drifted()
+    for name in names:
+        shutil.copyfile(os.path.join(ROOT, name), os.path.join(AISTAGER, name))
+    return names
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv[1:]:
+        names = drifted()
+        for name in names:
+            print(f'{name} differs from Claude Code Projects/AiStager/{name}')
+        sys.exit(1 if names else 0)
+    for name in sync():
+        print(f'Copied {name}')
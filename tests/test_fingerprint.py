@@ -0,0 +1,62 @@
+import io
+import os
+import random
+import sys
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fingerprint import FINGERPRINT_COLUMNS, FingerprintIndex
+from imaging import fingerprint_image
+from job_store import JobDatabase
+
+
+def encode(image, quality=90):
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
+
+def room():
+    # Stand-in for a listing photo: blurred furniture-like blocks on a wall
+    rng = random.Random(1)
+    image = Image.new('RGB', (1200, 800), (180, 170, 150))
+    draw = ImageDraw.Draw(image)
+    for _ in range(30):
+        x, y = rng.randrange(1200), rng.randrange(800)
+        draw.rectangle((x, y, x + rng.randrange(50, 300), y + rng.randrange(50, 300)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image.filter(ImageFilter.GaussianBlur(3))
+
+
+def index(tmp_path):
+    table = JobDatabase(str(tmp_path / 'jobs.db')).table('fingerprints', indexed=FINGERPRINT_COLUMNS)
+    return FingerprintIndex(table, exists=lambda image_id: True)
+
+
+def first_then(fingerprints, first, second):
+    phash, thumb, size = fingerprint_image(first)
+    fingerprints.add('first', 'image-1', phash, thumb, size)
+    return fingerprints.similar(*fingerprint_image(second))
+
+
+def test_reencoded_copy_maps_to_the_first_upload(tmp_path):
+    photo = room()
+    match = first_then(index(tmp_path), encode(photo), encode(photo.resize((600, 400)), quality=60))
+    assert match and match[0] == 'image-1'
+
+
+def test_distinct_images_sharing_a_dhash_do_not_match(tmp_path):
+    photo = room()
+    brighter = photo.point(lambda value: min(255, value + 40))
+    assert fingerprint_image(encode(photo))[0] == fingerprint_image(encode(brighter))[0]
+    assert first_then(index(tmp_path), encode(photo), encode(brighter)) is None
+
+
+def test_flat_and_graded_images_never_match(tmp_path):
+    gradient = Image.linear_gradient('L').rotate(90).resize((1200, 800)).convert('RGB')
+    light, dark = Image.new('RGB', (1200, 800), (200, 200, 200)), Image.new('RGB', (1200, 800), (10, 10, 12))
+    fingerprints = index(tmp_path)
+    assert first_then(fingerprints, encode(light), encode(dark)) is None
+    assert first_then(fingerprints, encode(gradient), encode(gradient, quality=60)) is None
@@ -0,0 +1,114 @@
+"""HostingRacer against local stand-in upload servers"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'Claude Code Projects', 'AiStager'))
+
+from hosting import HostingRacer, ImgBBProvider, LocalProvider
+
+
+class StandIn:
+    """An ImgBB-style upload endpoint answering after `delay` seconds with `status`"""
+
+    def __init__(self, name, delay=0.0, status=200):
+        self.name = name
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stand_in.requests += 1
+                time.sleep(stand_in.delay)
+                body = json.dumps({'success': True, 'data': {'url': f'https://{stand_in.name}.test/image.jpg'}})
+                self.send_response(stand_in.status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def provider(self):
+        provider = ImgBBProvider('key', url=f'http://127.0.0.1:{self.server.server_port}/upload', timeout=5)
+        provider.name = self.name
+        return provider
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MemoryStore(dict):
+    def put(self, key, data, mimetype):
+        self[key] = (data, mimetype)
+
+
+@pytest.fixture
+def stand_ins():
+    servers = []
+
+    def make(name, **kwargs):
+        server = StandIn(name, **kwargs)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+def racer(*providers, race_timeout=2.0):
+    return HostingRacer(list(providers), LocalProvider(MemoryStore(), {'image/jpeg': '.jpg'}), race_timeout)
+
+
+def test_first_successful_upload_wins(stand_ins):
+    slow = stand_ins('slow', delay=1.0)
+    fast = stand_ins('fast', delay=0.05)
+    hosting = racer(slow.provider(), fast.provider())
+
+    started = time.monotonic()
+    url, provider = hosting.host(b'image', 'image/jpeg', 'photo', 'http://app.test')
+    assert (url, provider) == ('https://fast.test/image.jpg', 'fast')
+    assert time.monotonic() - started < 0.9
+
+
+def test_failing_provider_cools_down(stand_ins):
+    broken = stand_ins('broken', status=500)
+    good = stand_ins('good', delay=0.2)
+    hosting = racer(broken.provider(), good.provider())
+
+    for _ in range(2):
+        assert hosting.host(b'image', 'image/jpeg', 'photo', 'http://app.test')[1] == 'good'
+    assert broken.requests == 2
+
+    # Two failures in a row put it in cooldown, so it is no longer tried
+    assert hosting.host(b'image', 'image/jpeg', 'photo', 'http://app.test')[1] == 'good'
+    assert broken.requests == 2
+    stats = hosting.stats()['providers']['broken']
+    assert stats['cooling_down'] and stats['skipped'] == 1
+
+
+def test_falls_back_to_local_when_the_race_times_out(stand_ins):
+    stuck = stand_ins('stuck', delay=2.0)
+    hosting = racer(stuck.provider(), race_timeout=0.3)
+
+    started = time.monotonic()
+    url, provider = hosting.host(b'image', 'image/jpeg', 'photo', 'http://app.test')
+    assert (url, provider) == ('http://app.test/temp-image/photo.jpg', 'local')
+    assert hosting.fallback.store['photo'] == (b'image', 'image/jpeg')
+    assert hosting.stats()['fallbacks'] == 1
+    assert time.monotonic() - started < 1.5
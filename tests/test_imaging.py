@@ -0,0 +1,45 @@
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imaging import ImageError, fingerprint_image, normalize_image
+
+
+def encode(fmt):
+    output = io.BytesIO()
+    Image.new('RGB', (64, 48), 'green').save(output, fmt)
+    return output.getvalue()
+
+
+def corrupt_png():
+    # Damage the IHDR chunk type, which Pillow reports as SyntaxError
+    data = bytearray(encode('PNG'))
+    data[12:16] = b':END'
+    return bytes(data)
+
+
+def corrupt_ppm():
+    # A non-numeric size field, which Pillow reports as ValueError
+    return encode('PPM').replace(b'64', b'6x', 1)
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'not an image', encode('JPEG')[:20], corrupt_png(), corrupt_ppm()
+], ids=['empty', 'text', 'truncated_jpeg', 'corrupt_png', 'corrupt_ppm'])
+@pytest.mark.parametrize('decode', [normalize_image, fingerprint_image])
+def test_corrupt_images_raise_image_error(decode, data):
+    with pytest.raises(ImageError):
+        decode(data)
+
+
+def test_normalize_image_reencodes_as_jpeg():
+    data, mimetype, info = normalize_image(encode('PNG'))
+    assert mimetype == 'image/jpeg'
+    assert info['original_format'] == 'PNG'
+    assert info['size'] == [64, 48]
+    assert len(info['phash']) == 16
@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_store import JobDatabase
+from jobs import JobEngine
+
+
+def test_running_jobs_keep_their_lease_and_finished_ones_lapse(tmp_path):
+    records = JobDatabase(str(tmp_path / 'jobs.db')).table('jobs', indexed=('status', 'next_check_at'))
+    engine = JobEngine(records=records, lease=0.4)
+    release = threading.Event()
+    job_id = engine.submit(lambda job_id: release.wait(5))
+
+    time.sleep(1.0)
+    now = datetime.now().isoformat()
+    assert records.due('next_check_at', now, 10, status=('queued', 'masking')) == []
+
+    release.set()
+    time.sleep(0.6)
+    now = datetime.now().isoformat()
+    assert [job['job_id'] for job in records.due('next_check_at', now, 10, status=('queued', 'masking'))] == [job_id]
+
+
+def test_due_filters_on_a_set_of_values(tmp_path):
+    records = JobDatabase(str(tmp_path / 'jobs.db')).table('jobs', indexed=('status', 'next_check_at'))
+    for job_id, status in (('a', 'masking'), ('b', 'submitted'), ('c', 'completed')):
+        records[job_id] = {'job_id': job_id, 'status': status, 'next_check_at': '2026-01-01T00:00:00'}
+
+    due = records.due('next_check_at', '2026-01-02', 10, status=('masking', 'submitted'))
+    assert sorted(job['job_id'] for job in due) == ['a', 'b']
+    assert [job['job_id'] for job in records.due('next_check_at', '2026-01-02', 10, status='completed')] == ['c']
+
+
+def test_jobs_in_one_pool_do_not_wait_behind_another():
+    engine = JobEngine(max_workers=1, pools={'batch': 2})
+    release = threading.Event()
+    for _ in range(4):
+        engine.submit(lambda job_id: release.wait(5), pool='batch')
+
+    started = threading.Event()
+    engine.submit(lambda job_id: started.set())
+    assert started.wait(1)
+    release.set()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from notify import Notifier
+
+
+def test_waiters_past_the_cap_are_turned_away_until_a_slot_frees():
+    notifier = Notifier(max_waiters=1)
+    with notifier.waiter() as first:
+        with notifier.waiter() as second:
+            assert first and not second
+    with notifier.waiter() as third:
+        assert third
+    assert notifier.stats() == {'waiters': 0, 'max_waiters': 1, 'turned_away': 1}
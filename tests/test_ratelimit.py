@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_store import JobDatabase
+from ratelimit import AdmissionControl, RateLimited
+
+LIMITS = {'rate_per_minute': 60, 'burst': 5, 'max_active': 3, 'max_waiting': 2, 'wait_timeout': 0.3}
+
+
+def admission(path):
+    # Each instance stands in for one gunicorn worker sharing the database
+    db = JobDatabase(path)
+    return AdmissionControl(LIMITS, store=db.table('settings'),
+                            buckets=db.table('rate_buckets', indexed=('updated_at',)),
+                            slots=db.table('admission'))
+
+
+def test_buckets_and_slots_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    first, second = admission(path), admission(path)
+
+    first.check_rate('client', cost=3)
+    with pytest.raises(RateLimited):
+        second.check_rate('client', cost=3)
+
+    first.acquire(2)
+    second.acquire(1)
+    with pytest.raises(RateLimited):
+        second.acquire(1)
+    assert first.stats()['concurrency']['active'] == 3
+
+    first.release(2)
+    second.acquire(2)
+    assert second.stats()['concurrency']['active'] == 3
+
+
+def test_a_batch_over_the_burst_needs_a_full_bucket_and_leaves_debt(tmp_path):
+    limiter = admission(str(tmp_path / 'jobs.db'))
+    limiter.check_rate('client', cost=20)
+    with pytest.raises(RateLimited) as limited:
+        limiter.check_rate('client')
+    assert limited.value.retry_after == pytest.approx(16, abs=0.5)
+
+
+def test_slots_of_a_vanished_worker_lapse(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    gone, live = admission(path), admission(path)
+    gone.concurrency.stale = live.concurrency.stale = 0.2
+    gone.acquire(3)
+    gone.concurrency._pid = None  # stops its heartbeat, as if the worker died
+
+    time.sleep(0.3)
+    live.acquire(3)
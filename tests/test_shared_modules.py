@@ -0,0 +1,10 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_shared
+
+
+def test_aistager_copies_match_the_shared_modules():
+    assert sync_shared.drifted() == [], 'run python sync_shared.py to update the AiStager copies'
@@ -0,0 +1,193 @@
+"""Per-stage timing of the staging pipeline, exported for Prometheus.
+
+Each step of a staging (decoding the upload, hosting it, create_mask,
+every status poll, generate_image, waiting for the webhook) runs inside a
+span. A span logs one JSON line tagged with the job id and feeds a
+latency histogram and an outcome counter labelled by stage, so /metrics
+shows where a 20-40 second staging spends its time.
+
+Every gunicorn worker keeps its own counters and copies a snapshot into a
+shared store every few seconds; /metrics adds up the snapshots of all
+workers, so whichever worker answers the scrape reports the whole app.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from webhooks import log_event
+
+# Upper bounds in seconds; stages range from sub-second polls to minute-long waits
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120, 300)
+
+METRIC_HELP = {
+    'stage_duration_seconds': 'Time spent in each staging pipeline stage',
+    'stage_total': 'Staging pipeline stages run, by outcome',
+    'events_total': 'Pipeline events, by kind and outcome'
+}
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Counters and latency histograms, keyed by metric name and label set.
+
+    store is a dict-like shared by every worker (a job_store table indexed
+    on updated_at); without one only this process's numbers are reported.
+    """
+
+    def __init__(self, prefix='aistager', store=None, flush_interval=5.0,
+                 buckets=LATENCY_BUCKETS, keep=100, clock=time.monotonic):
+        self.prefix = prefix
+        self.store = store
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.keep = keep
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flushed_at = clock()
+        self._flushes = 0
+        self.counters = {}
+        self.histograms = {}
+
+    def _reset_after_fork(self):
+        # Children of a preloading master must not re-report its numbers
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._reset_after_fork()
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + amount
+        self._maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            self._reset_after_fork()
+            series = self.histograms.setdefault(name, {})
+            # Per-bucket counts, then the sum and the total count
+            values = series.setdefault(_labels(labels), [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    values[i] += 1
+                    break
+            values[-2] += seconds
+            values[-1] += 1
+        self._maybe_flush()
+
+    @contextmanager
+    def span(self, stage, job_id=None, **labels):
+        """Time the block as one pipeline stage; exceptions count as errors.
+
+        Yields the labels dict, so labels only known at the end (such as
+        which host won) can be added inside the block.
+        """
+        started = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield labels
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self.observe('stage_duration_seconds', elapsed, stage=stage, **labels)
+            self.inc('stage_total', stage=stage, outcome=outcome, **labels)
+            log_event('span', stage=stage, job_id=job_id, outcome=outcome,
+                      ms=round(elapsed * 1000, 1), **labels)
+
+    def record(self, stage, seconds, job_id=None, outcome='ok', **labels):
+        """Record a stage timed elsewhere, e.g. the wait between submit and webhook"""
+        self.observe('stage_duration_seconds', seconds, stage=stage, **labels)
+        self.inc('stage_total', stage=stage, outcome=outcome, **labels)
+        log_event('span', stage=stage, job_id=job_id, outcome=outcome,
+                  ms=round(seconds * 1000, 1), **labels)
+
+    def _snapshot(self):
+        with self._lock:
+            self._reset_after_fork()
+            return {
+                'updated_at': time.time(),
+                'counters': {name: dict(series) for name, series in self.counters.items()},
+                'histograms': {
+                    name: {key: list(values) for key, values in series.items()}
+                    for name, series in self.histograms.items()
+                }
+            }
+
+    def _maybe_flush(self):
+        if self.store is None or self._clock() - self._flushed_at < self.flush_interval:
+            return
+        self.flush()
+
+    def flush(self):
+        """Copy this worker's numbers into the shared store"""
+        if self.store is None:
+            return
+        self._flushed_at = self._clock()
+        self.store[f'worker:{os.getpid()}'] = self._snapshot()
+        self._flushes += 1
+        if self._flushes % 100 == 0:
+            # Workers that have exited keep their last snapshot until trimmed
+            self.store.trim('updated_at', self.keep)
+
+    def _merged(self):
+        if self.store is None:
+            return [self._snapshot()]
+        self.flush()
+        return self.store.values()
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format"""
+        counters = {}
+        histograms = {}
+        for snapshot in self._merged():
+            for name, series in snapshot['counters'].items():
+                merged = counters.setdefault(name, {})
+                for key, value in series.items():
+                    merged[key] = merged.get(key, 0) + value
+            for name, series in snapshot['histograms'].items():
+                merged = histograms.setdefault(name, {})
+                for key, values in series.items():
+                    if len(values) != len(self.buckets) + 2:
+                        # Written with other buckets (a deploy changed them)
+                        continue
+                    current = merged.setdefault(key, [0] * len(values))
+                    merged[key] = [a + b for a, b in zip(current, values)]
+
+        lines = []
+        for name in sorted(counters):
+            full = f'{self.prefix}_{name}'
+            lines += self._header(name, full, 'counter')
+            for key, value in sorted(counters[name].items()):
+                lines.append(f'{full}{{{key}}} {value}' if key else f'{full} {value}')
+        for name in sorted(histograms):
+            full = f'{self.prefix}_{name}'
+            lines += self._header(name, full, 'histogram')
+            for key, values in sorted(histograms[name].items()):
+                prefix = f'{key},' if key else ''
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    lines.append(f'{full}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{full}_bucket{{{prefix}le="+Inf"}} {values[-1]}')
+                labels = f'{{{key}}}' if key else ''
+                lines.append(f'{full}_sum{labels} {round(values[-2], 6)}')
+                lines.append(f'{full}_count{labels} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _header(name, full, kind):
+        help_text = METRIC_HELP.get(name, name.replace('_', ' '))
+        return [f'# HELP {full} {help_text}', f'# TYPE {full} {kind}']
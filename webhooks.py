@@ -0,0 +1,199 @@
+"""Deferred webhook processing.
+
+Webhook routes only validate the payload and queue it; a background
+consumer thread does the slower work (building the stored result, writing
+the job records, waking long-polls and event streams). The route answers
+in constant time however large the payload is. When the queue is full the
+route answers 503 so ReimagineHome retries later.
+
+ReimagineHome may deliver the same callback more than once, out of order,
+or as progress updates ahead of the final one. Exact repeats are dropped
+at the route by a digest of the body; everything else is merged into the
+stored result, so a late progress update never overwrites a finished
+result.
+"""
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+
+# job_status values that mean more callbacks are coming
+PROGRESS_STATUSES = {'queued', 'pending', 'processing', 'in_progress', 'running', 'started'}
+
+
+def extract_output_urls(data):
+    """output_urls from a webhook payload, top level or under 'data'.
+
+    Status responses from generate_image/<id> list them as generated_images.
+    """
+    if not data:
+        return []
+    body = data.get('data') if isinstance(data.get('data'), dict) else {}
+    for source in (data, body):
+        for key in ('output_urls', 'generated_images'):
+            if key in source:
+                return source[key] or []
+    return []
+
+
+def webhook_result(data):
+    """The parts of a webhook payload worth keeping: ids, status and output URLs"""
+    body = data.get('data') if isinstance(data.get('data'), dict) else {}
+    result = {
+        'job_id': data.get('job_id') or body.get('job_id'),
+        'job_status': data.get('job_status') or body.get('job_status'),
+        'output_urls': extract_output_urls(data)
+    }
+    error_message = data.get('error_message') or body.get('error_message')
+    if error_message:
+        result['error_message'] = error_message
+    return result
+
+
+def is_final(result):
+    """True unless the result is a progress update (results without a status are final)"""
+    return str(result.get('job_status') or '').lower() not in PROGRESS_STATUSES
+
+
+def merge_results(current, update):
+    """Fold a new webhook result into the stored one.
+
+    Returns (merged, outcome): outcome is 'new', 'merged', 'unchanged' or
+    'stale' (a progress update arriving after the final result), and
+    merged is None unless something changed.
+    """
+    if current is None:
+        return update, 'new'
+    if is_final(current) and not is_final(update):
+        return None, 'stale'
+
+    merged = {**current, **{key: value for key, value in update.items() if value}}
+    urls = list(current.get('output_urls') or [])
+    urls += [url for url in update.get('output_urls') or [] if url not in urls]
+    merged['output_urls'] = urls
+    if merged == current:
+        return None, 'unchanged'
+    return merged, 'merged'
+
+
+def log_event(event, **fields):
+    """Write one compact JSON log line"""
+    print(json.dumps({'event': event, **fields}, default=str), flush=True)
+
+
+class WebhookQueue:
+    def __init__(self, maxsize=1000, workers=1):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def _get_queue(self):
+        # Consumers are started lazily (and again after a fork) so every
+        # gunicorn worker drains its own queue
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.maxsize)
+                self._pid = os.getpid()
+                for i in range(self.workers):
+                    threading.Thread(
+                        target=self._consume, args=(self._queue,),
+                        name=f'webhook-{i}', daemon=True
+                    ).start()
+            return self._queue
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) for the consumer; False if the queue is full"""
+        try:
+            self._get_queue().put_nowait((fn, args, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def _consume(self, work):
+        while True:
+            fn, args, queued_at = work.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                log_event('webhook_failed', handler=fn.__name__, error=str(e),
+                          queued_ms=round((time.monotonic() - queued_at) * 1000, 1))
+            else:
+                with self._lock:
+                    self.processed += 1
+            finally:
+                work.task_done()
+
+    def drain(self, timeout=5.0):
+        """Wait up to timeout seconds for queued webhooks to be processed"""
+        work = self._queue
+        if work is None or self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while work.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize() if self._queue is not None else 0,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed
+            }
+
+
+class WebhookDeduper:
+    """Drop webhook deliveries whose exact body was already accepted.
+
+    Claims are kept in a shared store (a job_store table indexed on
+    received_at) so repeats are caught whichever worker they reach; only
+    the newest `keep` claims are retained.
+    """
+
+    def __init__(self, store, keep=10000):
+        self.store = store
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._claims = 0
+        self.counts = {'new': 0, 'duplicate': 0, 'merged': 0, 'unchanged': 0, 'stale': 0}
+
+    def claim(self, scope, body):
+        """Claim a delivery; returns its key, or None if it is a repeat"""
+        key = f'{scope}:{hashlib.sha256(body).hexdigest()}'
+        if not self.store.add(key, {'received_at': time.time()}):
+            self.count('duplicate')
+            return None
+        with self._lock:
+            self._claims += 1
+            trim = self._claims % 1000 == 0
+        if trim:
+            self.store.trim('received_at', self.keep)
+        return key
+
+    def release(self, key):
+        """Forget a claim whose delivery could not be queued, so its retry is accepted"""
+        del self.store[key]
+
+    def count(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)